@@ -0,0 +1,152 @@
+import os
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+import numpy as np
+
+from cache import user_cache
+from database import get_analytics_rows, get_balance, get_user_goal
+
+TREND_DAYS = int(os.getenv("ANALYTICS_TREND_DAYS", 30))
+TREND_WEEKS = int(os.getenv("ANALYTICS_TREND_WEEKS", 12))
+MOVING_AVERAGE_DAYS = 7
+TOP_CATEGORIES = 5
+
+PERIOD_NAMES = {"day": "день", "week": "неделю", "month": "месяц", "year": "год"}
+_DAY = 24 * 3600
+_WEEK = 7 * _DAY
+_SPARKS = np.array(list("▁▂▃▄▅▆▇█"))
+
+
+# Операции пользователя по столбцам: выбираем из базы один раз,
+# дальше все отчёты считаются операциями над массивами
+class Columns:
+    def __init__(self, rows):
+        ts, expense, amount, category = zip(*rows) if rows else ((), (), (), ())
+        self.ts = np.array(ts, dtype=np.int64)
+        self.expense = np.array(expense, dtype=bool)
+        self.amount = np.array(amount, dtype=np.float64)
+        # Категории — коды в словаре categories, чтобы суммировать через bincount
+        self.categories, self.category = np.unique(np.array(category, dtype=object), return_inverse=True)
+
+
+def period_start(now, period):
+    # Начало текущей корзины периода (UTC, неделя с понедельника), как в database.period_buckets
+    day = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
+    if period == "day":
+        return day
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day.replace(month=1, day=1)
+
+
+def category_breakdown(cols, since, top=TOP_CATEGORIES):
+    # (все расходы, [(категория, сумма)]) по убыванию суммы; хвост после top — одной строкой
+    mask = cols.expense & (cols.ts >= since)
+    sums = np.bincount(cols.category[mask], weights=cols.amount[mask], minlength=len(cols.categories))
+    order = np.argsort(sums)[::-1]
+    order = order[sums[order] > 0]
+    breakdown = list(zip(cols.categories[order[:top]], sums[order[:top]]))
+    rest = sums[order[top:]].sum()
+    if rest:
+        breakdown.append(("остальное", rest))
+    return sums.sum(), breakdown
+
+
+def series(cols, start, step, count, expense=True):
+    # Суммы расходов (или доходов) по count корзинам длиной step секунд начиная со start
+    index = (cols.ts - start) // step
+    mask = (cols.expense == expense) & (index >= 0) & (index < count)
+    return np.bincount(index[mask], weights=cols.amount[mask], minlength=count)
+
+
+def moving_average(values, window=MOVING_AVERAGE_DAYS):
+    if len(values) < window:
+        return np.zeros(0)
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    return (sums[window:] - sums[:-window]) / window
+
+
+def goal_projection(daily_income, daily_expense, balance, goal_amount, days_left):
+    # Темп — средний чистый приток в день за окно тренда; (темп, баланс к сроку, успеваем ли)
+    rate = float((daily_income - daily_expense).mean()) if len(daily_income) else 0.0
+    projected = balance + rate * max(days_left, 0)
+    return rate, projected, projected >= goal_amount
+
+
+def sparkline(values):
+    top = values.max() if len(values) else 0
+    if top <= 0:
+        return _SPARKS[0] * len(values)
+    levels = np.rint(values / top * (len(_SPARKS) - 1)).astype(int)
+    return "".join(_SPARKS[levels])
+
+
+def build_report(rows, now, period, balance, goal):
+    cols = Columns(rows)
+    today = int(period_start(now, "day").timestamp())
+    lines = [f"📊 Подробно за {PERIOD_NAMES[period]}"]
+
+    total, breakdown = category_breakdown(cols, int(period_start(now, period).timestamp()))
+    if total:
+        lines.append("🗂 Расходы по категориям:")
+        lines += [f"• {name} — {amount:.0f} ₽ ({amount / total:.0%})" for name, amount in breakdown]
+    else:
+        lines.append("🗂 Расходов за период нет.")
+
+    trend_start = today - (TREND_DAYS - 1) * _DAY
+    daily_expense = series(cols, trend_start, _DAY, TREND_DAYS)
+    daily_income = series(cols, trend_start, _DAY, TREND_DAYS, expense=False)
+    lines.append(f"\n📉 Расходы за {TREND_DAYS} дн.: {sparkline(daily_expense)}")
+    average = moving_average(daily_expense)
+    if len(average):
+        text = f"Среднее за {MOVING_AVERAGE_DAYS} дн.: {average[-1]:.0f} ₽/день"
+        if len(average) > MOVING_AVERAGE_DAYS and average[-1 - MOVING_AVERAGE_DAYS]:
+            change = average[-1] / average[-1 - MOVING_AVERAGE_DAYS] - 1
+            text += f" ({change:+.0%} к прошлой неделе)"
+        lines.append(text)
+    week_start = int(period_start(now, "week").timestamp()) - (TREND_WEEKS - 1) * _WEEK
+    weekly_expense = series(cols, week_start, _WEEK, TREND_WEEKS)
+    lines.append(f"📆 По неделям ({TREND_WEEKS}): {sparkline(weekly_expense)}")
+
+    goal_amount, goal_end_date = goal
+    if goal_amount and goal_end_date:
+        end_date = date.fromisoformat(goal_end_date) if isinstance(goal_end_date, str) else goal_end_date
+        days_left = (end_date - now.date()).days
+        rate, projected, reached = goal_projection(daily_income, daily_expense, balance, goal_amount, days_left)
+        lines.append(f"\n🎯 Цель {goal_amount:.0f} ₽ к {end_date.strftime('%d.%m.%Y')}")
+        lines.append(f"Темп: {rate:+.0f} ₽/день, к сроку будет ~{projected:.0f} ₽")
+        if balance >= goal_amount:
+            lines.append("✅ Цель уже достигнута")
+        elif days_left <= 0:
+            lines.append("⌛ Срок цели прошёл")
+        elif reached:
+            lines.append("✅ При текущем темпе цель будет достигнута")
+        else:
+            lines.append(f"⚠️ Не успеваете: нужно {(goal_amount - balance) / days_left:+.0f} ₽/день")
+    return "\n".join(lines)
+
+
+async def load_rows(user_id, now):
+    # Все операции, нужные отчётам: текущий год или окно тренда, если оно длиннее
+    since = min(period_start(now, "year"), period_start(now, "week") - timedelta(weeks=TREND_WEEKS - 1))
+    return await get_analytics_rows(user_id, since)
+
+
+async def get_report(user_id, period):
+    # Готовый текст кэшируется до следующей записи пользователя (invalidate в database.py)
+    if period not in PERIOD_NAMES:
+        period = "month"
+    now = datetime.now(timezone.utc)
+    key = ("report", period, now.date().isoformat())
+    found, text = user_cache.get(user_id, key)
+    if found:
+        return text
+    generation = user_cache.generation(user_id)
+    rows = await load_rows(user_id, now)
+    balance = await get_balance(user_id)
+    goal = await get_user_goal(user_id)
+    text = await asyncio.to_thread(build_report, rows, now, period, balance, goal)
+    user_cache.set(user_id, key, text, generation)
+    return text
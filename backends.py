@@ -0,0 +1,499 @@
+import io
+import os
+import re
+import time
+import asyncio
+import threading
+import functools
+import psycopg2
+import aiosqlite
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import timezone
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_batch
+
+from metrics import db_acquire_seconds, db_connections_closed_total, db_connections_opened_total, query_seconds
+from queries import catalogue
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", 300))
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", 30))
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", 10))
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", 256))
+PG_BATCH_PAGE_SIZE = int(os.getenv("PG_BATCH_PAGE_SIZE", 200))
+
+
+async def _settle(fut):
+    # Дожидается future из пула потоков, не реагируя на повторные отмены
+    while not fut.done():
+        try:
+            await asyncio.wait({fut})
+        except asyncio.CancelledError:
+            pass
+
+
+# Соединение помнит, какие запросы из каталога на нём уже подготовлены
+class PreparedConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# Пул соединений psycopg2 с проверкой здоровья и вытеснением простаивающих.
+# Все блокирующие вызовы идут через отдельный ограниченный пул потоков,
+# так что медленный запрос не останавливает цикл событий aiogram
+class PgPool:
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 idle_timeout=DB_POOL_IDLE_TIMEOUT, check_after=DB_POOL_CHECK_AFTER,
+                 query_timeout=DB_QUERY_TIMEOUT):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.query_timeout = query_timeout
+        self._idle = deque()  # (conn, время возврата в пул)
+        self._size = 0
+        self._lock = threading.Lock()
+        self._slots = asyncio.Semaphore(maxconn)
+        # Потоков ровно столько, сколько соединений: каждому выданному соединению — свой поток
+        self._executor = ThreadPoolExecutor(max_workers=maxconn, thread_name_prefix="pg")
+        self._closed = False
+
+    async def run_blocking(self, fn, *args):
+        # Время запроса ограничивает только сервер (statement_timeout, connect_timeout). Клиент поток
+        # не бросает: отменённый вызов дожидается его, иначе commit мог бы пройти уже после ошибки,
+        # а соединение вернулось бы в пул, пока поток ещё работает с ним
+        fut = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            await _settle(fut)
+            raise
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            self.dsn,
+            connection_factory=PreparedConnection,
+            options=f"-c statement_timeout={int(self.query_timeout * 1000)}",
+            connect_timeout=max(int(self.query_timeout), 1)
+        )
+        with self._lock:
+            self._size += 1
+        db_connections_opened_total.inc("postgres")
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._size -= 1
+        db_connections_closed_total.inc("postgres")
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, released_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.check_after:
+            return True
+        # Соединение долго лежало без дела — проверяем, что сервер его не закрыл
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, released_at = self._idle.pop()
+            if self._healthy(conn, released_at):
+                return conn
+            self._discard(conn)
+        return self._connect()
+
+    def _checkin(self, conn):
+        if self._closed or conn.closed:
+            self._discard(conn)
+            return
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            # Сессии чтения не коммитят, а запись могла оборваться на ошибке — откатываем.
+            # PREPARE не транзакционный: подготовленные запросы переживают откат
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+
+    def open(self):
+        for _ in range(self.minconn):
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError("Пул соединений закрыт")
+        await self._slots.acquire()
+        fut = asyncio.get_running_loop().run_in_executor(self._executor, self._checkout)
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # Выдачу не бросаем на полпути: соединение, полученное уже после отмены,
+            # возвращается в пул, иначе _size вырос бы, а слот освободился
+            await _settle(fut)
+            if not fut.cancelled() and fut.exception() is None:
+                await self.release(fut.result())
+                raise
+            self._slots.release()
+            raise
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, conn):
+        try:
+            await self.run_blocking(self._checkin, conn)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {"size": self._size, "idle": len(self._idle), "max": self.maxconn}
+
+    def evict_idle(self):
+        # Самые старые соединения лежат в начале очереди
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle or self._size <= self.minconn:
+                    return
+                conn, released_at = self._idle[0]
+                if now - released_at < self.idle_timeout:
+                    return
+                self._idle.popleft()
+            self._discard(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, _ = self._idle.popleft()
+            self._discard(conn)
+        self._executor.shutdown(wait=True)
+
+
+def _timed(method):
+    # Время каждого запроса по его имени в каталоге (метрика bot_db_query_seconds)
+    @functools.wraps(method)
+    async def wrapper(self, name, *args):
+        started = time.perf_counter()
+        try:
+            return await method(self, name, *args)
+        finally:
+            query_seconds.observe(name, time.perf_counter() - started)
+    return wrapper
+
+
+def _copy_value(value):
+    # Текстовый формат COPY: \N — NULL, спецсимволы экранируются обратной косой
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def _to_pg(sql):
+    # "?" -> $1, $2, ... для PREPARE; возвращает текст и число параметров
+    counter = iter(range(1, sql.count("?") + 1))
+    return re.sub(r"\?", lambda _: f"${next(counter)}", sql), sql.count("?")
+
+
+class PostgresSession:
+    def __init__(self, backend, conn):
+        self._backend = backend
+        self._conn = conn
+
+    def _prepared_cursor(self, name):
+        sql, nparams = self._backend.statements[name]
+        cur = self._conn.cursor()
+        if name not in self._conn.prepared:
+            cur.execute(f"PREPARE {name} AS {sql}")
+            self._conn.prepared.add(name)
+        args = "(" + ", ".join(["%s"] * nparams) + ")" if nparams else ""
+        return cur, f"EXECUTE {name} {args}"
+
+    def _execute(self, name, params):
+        cur, stmt = self._prepared_cursor(name)
+        cur.execute(stmt, params)
+        return cur
+
+    def _executemany(self, name, seq):
+        # execute_batch склеивает EXECUTE в пачки — один сетевой обмен на страницу, а не на строку
+        cur, stmt = self._prepared_cursor(name)
+        execute_batch(cur, stmt, seq, page_size=PG_BATCH_PAGE_SIZE)
+        return cur.rowcount
+
+    def _copy(self, name, rows):
+        data = io.StringIO("".join(
+            "\t".join(_copy_value(value) for value in row) + "\n" for row in rows
+        ))
+        cur = self._conn.cursor()
+        cur.copy_expert(self._backend.statements[name][0], data)
+        return cur.rowcount
+
+    def _script(self, sql):
+        self._conn.cursor().execute(sql)
+
+    async def _run(self, fn, *args):
+        return await self._backend.pool.run_blocking(fn, *args)
+
+    @_timed
+    async def execute(self, name, params=()):
+        return (await self._run(self._execute, name, params)).rowcount
+
+    @_timed
+    async def fetchone(self, name, params=()):
+        return (await self._run(self._execute, name, params)).fetchone()
+
+    @_timed
+    async def fetchall(self, name, params=()):
+        return (await self._run(self._execute, name, params)).fetchall()
+
+    @_timed
+    async def executemany(self, name, seq):
+        return await self._run(self._executemany, name, seq)
+
+    @_timed
+    async def copy(self, name, rows):
+        return await self._run(self._copy, name, rows)
+
+    async def script(self, sql):
+        await self._run(self._script, sql)
+
+    async def commit(self):
+        await self._run(self._conn.commit)
+
+    async def rollback(self):
+        # Подготовленные запросы откат не отменяет, conn.prepared остаётся верным
+        await self._run(self._conn.rollback)
+
+
+class PostgresBackend:
+    dialect = "postgres"
+
+    def __init__(self, dsn):
+        self.pool = PgPool(dsn)
+        self.queries = catalogue(self.dialect)
+        self.statements = {name: _to_pg(sql) for name, sql in self.queries.items()}
+        self._evict_task = None
+
+    def timestamp(self, moment):
+        return moment
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(self.pool.idle_timeout / 2)
+            await self.pool.run_blocking(self.pool.evict_idle)
+
+    async def open(self):
+        await self.pool.run_blocking(self.pool.open)
+        self._evict_task = asyncio.create_task(self._evict_loop())
+
+    async def close(self):
+        if self._evict_task is not None:
+            self._evict_task.cancel()
+            self._evict_task = None
+        await asyncio.get_running_loop().run_in_executor(None, self.pool.close)
+
+    def stats(self):
+        return self.pool.stats()
+
+    @asynccontextmanager
+    async def session(self):
+        started = time.perf_counter()
+        conn = await self.pool.acquire()
+        db_acquire_seconds.observe(self.dialect, time.perf_counter() - started)
+        try:
+            yield PostgresSession(self, conn)
+        finally:
+            await self.pool.release(conn)
+
+
+class SQLiteSession:
+    def __init__(self, backend, conn):
+        self._queries = backend.queries
+        self._conn = conn
+
+    @_timed
+    async def execute(self, name, params=()):
+        cursor = await self._conn.execute(self._queries[name], params)
+        return cursor.rowcount
+
+    @_timed
+    async def fetchone(self, name, params=()):
+        cursor = await self._conn.execute(self._queries[name], params)
+        return await cursor.fetchone()
+
+    @_timed
+    async def fetchall(self, name, params=()):
+        cursor = await self._conn.execute(self._queries[name], params)
+        return list(await cursor.fetchall())
+
+    @_timed
+    async def executemany(self, name, seq):
+        cursor = await self._conn.executemany(self._queries[name], seq)
+        return cursor.rowcount
+
+    async def copy(self, name, rows):
+        # COPY в SQLite нет — тот же INSERT пачкой
+        return await self.executemany(name, rows)
+
+    async def script(self, sql):
+        await self._conn.execute(sql)
+
+    async def commit(self):
+        await self._conn.commit()
+
+    async def rollback(self):
+        await self._conn.rollback()
+
+
+class SQLiteBackend:
+    dialect = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.queries = catalogue(self.dialect)
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._waiting = 0
+
+    def timestamp(self, moment):
+        # Тот же формат, что у CURRENT_TIMESTAMP: UTC без смещения
+        return moment.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    async def open(self):
+        # Одно долгоживущее соединение на процесс, WAL позволяет читать во время записи.
+        # Тексты запросов из каталога постоянны, поэтому sqlite3 берёт
+        # скомпилированные выражения из своего кэша и не разбирает их заново
+        self._conn = await aiosqlite.connect(self.path, cached_statements=SQLITE_STATEMENT_CACHE)
+        db_connections_opened_total.inc("sqlite")
+        await self._conn.execute("PRAGMA journal_mode=WAL")
+        await self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    async def close(self):
+        await self._conn.close()
+        self._conn = None
+        db_connections_closed_total.inc("sqlite")
+
+    def stats(self):
+        return {"size": 1 if self._conn is not None else 0, "waiting": self._waiting}
+
+    @asynccontextmanager
+    async def session(self):
+        # Соединение общее, поэтому транзакции разных корутин не должны перемешиваться
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self._lock.acquire()
+        finally:
+            self._waiting -= 1
+        db_acquire_seconds.observe(self.dialect, time.perf_counter() - started)
+        try:
+            yield SQLiteSession(self, self._conn)
+        finally:
+            # Незакоммиченная запись — ошибка или отмена задачи (CancelledError) посреди
+            # транзакции — откатывается, иначе её закоммитит следующая корутина
+            try:
+                if self._conn.in_transaction:
+                    await self._conn.rollback()
+            finally:
+                self._lock.release()
+
+
+def create_backend(database_url, sqlite_path):
+    if database_url:
+        return PostgresBackend(database_url)
+    return SQLiteBackend(sqlite_path)
+
+
+async def _bench(args):
+    # Перекрываются ли обработчики: users одновременных «обработчиков», у каждого медленный
+    # запрос на slow секунд. Сравнение — тот же запрос прямо в корутине, как было до пула.
+    # Параллельно тикает таймер: его запаздывание — насколько цикл событий был занят
+    async def ticker(lag):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag.append(time.perf_counter() - started - 0.01)
+
+    async def run(handler):
+        lag = []
+        tick = asyncio.create_task(ticker(lag))
+        await asyncio.sleep(0.05)
+        in_flight = peak = 0
+
+        async def one():
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            try:
+                await handler()
+            finally:
+                in_flight -= 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(args.users)))
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0.05)  # таймер досчитывает последний такт
+        tick.cancel()
+        return elapsed, peak, max(lag, default=0.0)
+
+    async def pooled():
+        async with backend.session() as db:
+            await db.script(f"SELECT pg_sleep({args.slow})")
+
+    conn = psycopg2.connect(args.database_url)
+
+    async def in_loop():
+        # Так выглядел вызов psycopg2 в async def до пула: поток цикла стоит на execute
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_sleep(%s)", (args.slow,))
+        conn.rollback()
+
+    backend = PostgresBackend(args.database_url)
+    await backend.open()
+    try:
+        serial = args.users * args.slow
+        print(f"{args.users} обработчиков, запрос {args.slow * 1000:.0f} мс, пул {backend.pool.maxconn} соединений; "
+              f"подряд это {serial:.1f} с")
+        print(f"{'режим':<14} {'время, с':>9} {'перекрытие':>11} {'одновременно':>13} {'задержка цикла, мс':>19}")
+        for name, handler in (("в корутине", in_loop), ("пул потоков", pooled)):
+            elapsed, peak, lag = await run(handler)
+            print(f"{name:<14} {elapsed:>9.2f} {serial / elapsed:>10.1f}× {peak:>13} {lag * 1000:>19.1f}")
+    finally:
+        conn.close()
+        await backend.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Замер: не блокируют ли запросы Postgres цикл событий")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), required=not os.getenv("DATABASE_URL"))
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--slow", type=float, default=0.2, help="длительность медленного запроса, с")
+    asyncio.run(_bench(parser.parse_args()))
@@ -1,22 +1,62 @@
 import asyncio
 import os
+import signal
+import tempfile
 from datetime import datetime, date
 from aiogram import Bot, Dispatcher
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import Message, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiohttp import web
 
 from database import *
+from dedup import setup_dedup
+from cache import user_cache
+from fsm_storage import DatabaseStorage
+from outbox import SEND_RATE, SendQueue
+from analytics import get_report
+from charts import send_chart, start_charts, close_charts, stats as chart_stats
+from metrics import instrument, registry, setup_metrics, start_loop_monitor
+from quick_entry import parse_entry
+from scheduler import setup_scheduler, stop_scheduler
+from transfer import import_file, export_file
+from webhook import WEBHOOK_URL, UpdateQueue, setup_webhook, register_webhook
+from workers import BOT_WORKERS, ShardRouter, poll_updates
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN is required")
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Свой адрес Bot API: локальный telegram-bot-api или заглушка из loadtest.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+# Все отправки идут через общую очередь с лимитами Telegram; лимит на бота
+# делится между процессами, у каждого чата один процесс — и своё ведро
+outbox = SendQueue(rate=SEND_RATE / max(BOT_WORKERS, 1))
+bot.session.middleware(outbox)
+# Состояния диалогов храним в базе, чтобы они переживали передеплой
+# и были общими для нескольких процессов; FSM_STORAGE=memory — как раньше
+if os.getenv("FSM_STORAGE", "database") == "memory":
+    storage = MemoryStorage()
+else:
+    storage = DatabaseStorage()
+dp = Dispatcher(storage=storage)
+# Время каждого обработчика и число обновлений в работе — на /metrics
+instrument(dp)
+# Повторные доставки и двойные нажатия отсекаются до FSM и обработчиков
+dedup = setup_dedup(dp)
+registry.collect("bot_outbox", "Очередь исходящих запросов к Telegram", "stat", outbox.stats)
+registry.collect("bot_cache", "Кэш данных пользователей", "stat", user_cache.stats)
+registry.collect("bot_dedup", "Отброшенные повторы обновлений и нажатий", "stat", dedup.stats)
+registry.collect("bot_charts", "Рендер графиков", "stat", lambda: chart_stats)
+registry.collect("bot_db_pool", "Соединения с базой и буфер записи", "stat", db_stats)
 IS_RENDER = os.getenv("RENDER") is not None
 
 class States(StatesGroup):
@@ -24,6 +64,7 @@ class States(StatesGroup):
     expense = State()
     goal = State()
     todo = State()
+    import_file = State()
 
 # 🎨 Главное меню
 main_menu = ReplyKeyboardMarkup(
@@ -39,7 +80,6 @@ main_menu = ReplyKeyboardMarkup(
 # 📱 /start
 @dp.message(Command("start"))
 async def start(message: Message):
-    await init_db()
     await message.answer("👋 Привет! Я ваш финансовый помощник.", reply_markup=main_menu)
 
 # 💰 Доход
@@ -184,64 +224,122 @@ async def stats_menu(message: Message):
         [InlineKeyboardButton(text="📆 За неделю", callback_data="stats:week")],
         [InlineKeyboardButton(text="📆 За месяц", callback_data="stats:month")],
         [InlineKeyboardButton(text="📆 За год", callback_data="stats:year")],
+        [InlineKeyboardButton(text="🗂 Сравнить периоды", callback_data="stats:all")],
         [InlineKeyboardButton(text="← Назад", callback_data="back:main")]
     ])
     await message.answer("📈 Выберите период:", reply_markup=kb)
 
+@dp.callback_query(lambda c: c.data == "stats:all")
+async def show_stats_all(callback):
+    names = {"day": "День", "week": "Неделя", "month": "Месяц", "year": "Год"}
+    balance, periods = await get_stats_all_periods(callback.from_user.id)
+    lines = [
+        f"{names[period]}: 📥 {income:.0f} ₽ / 📤 {expense:.0f} ₽"
+        for period, (income, expense) in periods.items()
+    ]
+    await callback.message.edit_text(
+        "📈 Сравнение периодов:\n" + "\n".join(lines) + f"\n💰 Баланс: {balance:.0f} ₽",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="← Назад", callback_data="back:stats")]
+        ])
+    )
+    await callback.answer()
+
 @dp.callback_query(lambda c: c.data.startswith("stats:"))
 async def show_stats(callback):
     period = callback.data.split(":")[1]
     names = {"day": "день", "week": "неделю", "month": "месяц", "year": "год"}
-    expense = await get_expenses_by_period(callback.from_user.id, period)
-    income = await get_income(callback.from_user.id)
-    balance = await get_balance(callback.from_user.id)
-    
+    income, expense, balance = await get_stats_snapshot(callback.from_user.id, period)
+
     await callback.message.edit_text(
         f"📈 За {names[period]}:\n"
         f"📥 Доходы: {income:.0f} ₽\n"
         f"📤 Расходы: {expense:.0f} ₽\n"
         f"💰 Баланс: {balance:.0f} ₽",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📊 Подробнее", callback_data=f"report:{period}"),
+             InlineKeyboardButton(text="🖼 График", callback_data=f"chart:{period}")],
             [InlineKeyboardButton(text="← Назад", callback_data="back:stats")]
         ])
     )
     await callback.answer()
 
+@dp.callback_query(lambda c: c.data.startswith("report:"))
+async def show_report(callback):
+    period = callback.data.split(":")[1]
+    await callback.message.edit_text(
+        await get_report(callback.from_user.id, period),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="← Назад", callback_data=f"stats:{period}")]
+        ])
+    )
+    await callback.answer()
+
+@dp.callback_query(lambda c: c.data.startswith("chart:"))
+async def show_chart(callback):
+    await callback.answer("🖼 Рисую график…")
+    await send_chart(bot, callback.message.chat.id, callback.from_user.id, callback.data.split(":")[1])
+
 @dp.callback_query(lambda c: c.data == "back:stats")
 async def back_stats(callback):
     await stats_menu(callback.message)
 
 # 📋 Задачи — С УДАЛЕНИЕМ ПРИ ВЫПОЛНЕНИИ
-@dp.message(lambda m: m.text == "📋 Задачи")
-async def todos_menu(message: Message):
-    todos = await get_todos(message.from_user.id)
+TODOS_PAGE_SIZE = 10
+
+async def todos_view(user_id, after_id=None, before_id=None):
+    todos, has_prev, has_next = await get_todos_page(user_id, after_id, TODOS_PAGE_SIZE, before_id)
+    if not todos and (after_id or before_id):
+        # Страница опустела (задачи удалили) — показываем начало списка
+        todos, has_prev, has_next = await get_todos_page(user_id, None, TODOS_PAGE_SIZE)
     if not todos:
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="+ Добавить", callback_data="todo:add")],
             [InlineKeyboardButton(text="← Назад", callback_data="back:main")]
         ])
-        await message.answer("📭 Нет задач.", reply_markup=kb)
-        return
+        return "📭 Нет задач.", kb
 
     kb = []
-    for i, (tid, text, done, due_date) in enumerate(todos, 1):
+    for tid, text, done, due_date in todos:
         mark = "✅ " if done else ""
         kb.append([
             InlineKeyboardButton(
-                text=f"{i}. {mark}{text}",
+                text=f"{mark}{text}",
                 callback_data=f"todo:select:{tid}"
             )
         ])
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"todo:page:before:{todos[0][0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"todo:page:after:{todos[-1][0]}"))
+    if nav:
+        kb.append(nav)
     kb.append([InlineKeyboardButton(text="+ Добавить", callback_data="todo:add")])
     kb.append([InlineKeyboardButton(text="← Назад", callback_data="back:main")])
-    
-    await message.answer("📋 Ваши задачи:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+
+    return "📋 Ваши задачи:", InlineKeyboardMarkup(inline_keyboard=kb)
+
+@dp.message(lambda m: m.text == "📋 Задачи")
+async def todos_menu(message: Message, user_id=None):
+    # user_id передаётся, когда меню открывается из колбэка: там message от бота
+    text, kb = await todos_view(user_id or message.from_user.id)
+    await message.answer(text, reply_markup=kb)
+
+@dp.callback_query(lambda c: c.data.startswith("todo:page:"))
+async def todos_page(callback):
+    _, _, direction, todo_id = callback.data.split(":")
+    if direction == "after":
+        text, kb = await todos_view(callback.from_user.id, after_id=int(todo_id))
+    else:
+        text, kb = await todos_view(callback.from_user.id, before_id=int(todo_id))
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
 
 @dp.callback_query(lambda c: c.data.startswith("todo:select:"))
 async def todo_select(callback):
     todo_id = int(callback.data.split(":")[2])
-    todos = await get_todos(callback.from_user.id)
-    selected = next((t for t in todos if t[0] == todo_id), None)
+    selected = await get_todo(callback.from_user.id, todo_id)
     if not selected:
         await callback.answer("Задача не найдена.")
         return
@@ -266,8 +364,7 @@ async def todo_select(callback):
 @dp.callback_query(lambda c: c.data.startswith("todo:toggle:"))
 async def toggle_todo_handler(callback):
     todo_id = int(callback.data.split(":")[2])
-    todos = await get_todos(callback.from_user.id)
-    selected = next((t for t in todos if t[0] == todo_id), None)
+    selected = await get_todo(callback.from_user.id, todo_id)
     if not selected:
         await callback.answer("Задача не найдена.")
         return
@@ -275,29 +372,98 @@ async def toggle_todo_handler(callback):
     _, _, done, _ = selected
     if done:
         # Удаляем задачу
-        await delete_todo(todo_id)
+        await delete_todo(callback.from_user.id, todo_id)
         await callback.message.edit_text("🗑 Задача удалена.")
     else:
         # Отмечаем как выполненную
-        await toggle_todo(todo_id)
+        await complete_todo(callback.from_user.id, todo_id)
         await callback.message.edit_text("✅ Задача отмечена как выполненная.")
 
-    await todos_menu(callback.message)
+    await todos_menu(callback.message, user_id=callback.from_user.id)
     await callback.answer()
 
 # Добавить задачу
 @dp.callback_query(lambda c: c.data == "todo:add")
 async def todo_add(callback, state: FSMContext):
-    await callback.message.edit_text("📝 Введите задачу:")
+    await callback.message.edit_text("📝 Введите задачу (срок — в конце, необязательно): `Оплатить интернет 15.12.2025`")
     await state.set_state(States.todo)
     await callback.answer()
 
 @dp.message(States.todo)
 async def process_todo(message: Message, state: FSMContext):
-    await add_todo(message.from_user.id, message.text)
+    text, due_date = message.text.strip(), None
+    parts = text.rsplit(maxsplit=1)
+    if len(parts) == 2:
+        try:
+            due_date = datetime.strptime(parts[1], "%d.%m.%Y").date()
+            text = parts[0]
+        except ValueError:
+            pass
+    await add_todo(message.from_user.id, text, due_date)
     await message.answer("✅ Задача добавлена!", reply_markup=main_menu)
     await state.clear()
 
+# 📥 Импорт операций из CSV / JSONL
+@dp.message(Command("import"))
+async def import_start(message: Message, state: FSMContext):
+    await message.answer(
+        "📥 Пришлите CSV-файл со столбцами `date, type, amount, category` "
+        "(или JSONL с теми же полями). Тип — income/expense или доход/расход; "
+        "без типа расход записывается отрицательной суммой. Дата — ГГГГ-ММ-ДД или ДД.ММ.ГГГГ, время в UTC. "
+        "Telegram отдаёт ботам файлы до 20 МБ."
+    )
+    await state.set_state(States.import_file)
+
+@dp.message(States.import_file)
+async def process_import(message: Message, state: FSMContext):
+    await state.clear()
+    if not message.document:
+        await message.answer("❌ Нужен файл. Начните заново: /import", reply_markup=main_menu)
+        return
+    suffix = os.path.splitext(message.document.file_name or "")[1].lower()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "import" + suffix)
+            await bot.download(message.document, destination=path)
+            report = await import_file(message.from_user.id, path)
+    except Exception as e:
+        print(f"❌ Ошибка импорта у {message.from_user.id}: {e}")
+        await message.answer("❌ Не удалось загрузить файл.", reply_markup=main_menu)
+        return
+    text = f"✅ Загружено операций: {report.imported}"
+    if report.skipped:
+        text += f"\n⚠️ Пропущено строк: {report.skipped} (например, {', '.join(map(str, report.errors))})"
+    await message.answer(text, reply_markup=main_menu)
+
+# 📤 Экспорт всех операций в CSV
+@dp.message(Command("export"))
+async def export(message: Message):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "transactions.csv")
+        count = await export_file(message.from_user.id, path)
+        if not count:
+            await message.answer("📭 Операций пока нет.")
+            return
+        await message.answer_document(FSInputFile(path), caption=f"📤 Операций: {count}")
+
+# ⚡ Быстрая запись одной строкой: «-350 кофе», «+50000 зарплата 12.10»
+def quick_entry(message: Message):
+    entry = parse_entry(message.text) if message.text else None
+    return {"entry": entry} if entry else False
+
+@dp.message(StateFilter(None), quick_entry)
+async def process_quick_entry(message: Message, entry):
+    t_type, amount, category, created_at = entry
+    await add_transaction(message.from_user.id, t_type, amount, category, created_at)
+    amount_text = f"{amount:.2f}".rstrip("0").rstrip(".")
+    if t_type == "income":
+        text = f"✅ Доход +{amount_text} ₽ · {category}"
+    else:
+        text = f"✅ Расход {amount_text} ₽ · {category}"
+    if created_at:
+        text += f" · {created_at.strftime('%d.%m.%Y')}"
+    await message.answer(text, reply_markup=main_menu)
+
 # ← Назад
 @dp.callback_query(lambda c: c.data == "back:main")
 async def back_main(callback):
@@ -306,22 +472,84 @@ async def back_main(callback):
 
 @dp.callback_query(lambda c: c.data == "back:todos")
 async def back_todos(callback):
-    await todos_menu(callback.message)
+    await todos_menu(callback.message, user_id=callback.from_user.id)
 
 # 🚀 Запуск
 async def main():
-    await init_db()
-    
-    if IS_RENDER:
+    await open_db()
+    runner = None
+    updates = None
+    scheduler = None
+    lag_monitor = None
+    try:
+        await init_db()
+        if isinstance(storage, DatabaseStorage):
+            storage.start()
+        # Напоминания рассылает только главный процесс, чтобы не было дублей
+        scheduler = setup_scheduler(bot)
+        scheduler.start()
+        if BOT_WORKERS <= 1:
+            # С несколькими процессами графики рисуют пулы в процессах-обработчиках
+            await start_charts()
+
         app = web.Application()
         app.router.add_get("/", lambda _: web.Response(text="Bot is alive"))
-        port = int(os.environ.get("PORT", 10000))
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, "0.0.0.0", port)
-        await site.start()
-
-    await dp.start_polling(bot)
+        app.router.add_get("/outbox", lambda _: web.json_response(outbox.stats()))
+        if BOT_WORKERS > 1:
+            # Несколько процессов: этот только принимает обновления и раздаёт их по user_id
+            updates = ShardRouter(BOT_WORKERS)
+            app.router.add_get("/workers", lambda _: web.json_response(updates.stats()))
+        elif WEBHOOK_URL:
+            updates = UpdateQueue(dp, bot)
+        if WEBHOOK_URL:
+            setup_webhook(app, updates, BOT_TOKEN)
+        setup_metrics(app, updates if isinstance(updates, ShardRouter) else None)
+        if updates:
+            registry.collect("bot_updates", "Очередь входящих обновлений", "stat", lambda: {
+                name: value for name, value in updates.stats().items() if isinstance(value, (int, float))
+            })
+        lag_monitor = start_loop_monitor()
+
+        if IS_RENDER or WEBHOOK_URL:
+            port = int(os.environ.get("PORT", 10000))
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "0.0.0.0", port)
+            await site.start()
+
+        if updates:
+            updates.start()
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+            await dp.emit_startup(bot=bot)
+            if WEBHOOK_URL:
+                # Вебхук: Telegram сам присылает обновления на наш aiohttp-сервер
+                await register_webhook(dp, bot, BOT_TOKEN)
+                await stop.wait()
+            else:
+                await bot.delete_webhook()
+                poller = asyncio.create_task(poll_updates(bot, dp, updates))
+                await stop.wait()
+                poller.cancel()
+            await dp.emit_shutdown(bot=bot)
+        else:
+            # Запасной вариант — long polling в этом же процессе; вебхук при этом нужно снять
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if lag_monitor:
+            lag_monitor.cancel()
+        if scheduler:
+            await stop_scheduler(scheduler)
+        if runner:
+            await runner.cleanup()
+        if updates:
+            await updates.stop()
+        await close_charts()
+        await storage.close()
+        await close_db()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+import os
+import time
+from collections import OrderedDict
+from itertools import count
+
+CACHE_MAX_USERS = int(os.getenv("CACHE_MAX_USERS", 10000))
+CACHE_TTL = float(os.getenv("CACHE_TTL", 300))
+# Кэш сбрасывается только в своём процессе. Это верно, пока все обновления пользователя
+# обрабатывает один процесс: один инстанс бота или BOT_WORKERS > 1 (ShardRouter делит
+# по user_id). Несколько инстансов за балансировщиком, которые получают обновления любого
+# пользователя, должны либо шардировать по user_id, либо запускаться с CACHE_USER_AFFINE=0 —
+# тогда кэш выключен: запись на одном инстансе не сбросила бы кэш на другом
+CACHE_USER_AFFINE = os.getenv("CACHE_USER_AFFINE", "1") != "0"
+
+
+# LRU по пользователям с TTL на каждую запись. Запись пользователя сбрасывается
+# целиком при любой его записи в базу (invalidate), поэтому TTL — лишь страховка.
+#
+# Поколения защищают от гонки: чтение, начатое до записи, не должно положить
+# в кэш старое значение после invalidate(). set() принимает поколение,
+# снятое до запроса в базу, и молча ничего не делает, если оно устарело.
+class UserCache:
+    def __init__(self, max_users=CACHE_MAX_USERS, ttl=CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._users = OrderedDict()  # user_id -> {ключ: (истекает, значение)}
+        self._generations = {}
+        self._counter = count(1)
+        self._floor = 0  # поколение для пользователей, о которых ничего не помним
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, user_id, key):
+        entries = self._users.get(user_id)
+        if entries is not None:
+            entry = entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._users.move_to_end(user_id)
+                    self.hits += 1
+                    return True, value
+                del entries[key]
+        self.misses += 1
+        return False, None
+
+    def generation(self, user_id):
+        return self._generations.get(user_id, self._floor)
+
+    def set(self, user_id, key, value, generation):
+        if self.ttl <= 0 or generation != self.generation(user_id):
+            return
+        entries = self._users.get(user_id)
+        if entries is None:
+            entries = self._users[user_id] = {}
+        self._users.move_to_end(user_id)
+        entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self._users) > self.max_users:
+            evicted, _ = self._users.popitem(last=False)
+            self._generations.pop(evicted, None)
+            self._floor = next(self._counter)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        self._users.pop(user_id, None)
+        self._generations[user_id] = next(self._counter)
+        self.invalidations += 1
+        # Поколения нужны только тем, кто сейчас в кэше или вот-вот в него попадёт
+        if len(self._generations) > self.max_users * 2:
+            self._generations = {u: g for u, g in self._generations.items() if u in self._users}
+            self._floor = next(self._counter)
+
+    def clear(self):
+        self._users.clear()
+        self._generations.clear()
+        self._floor = next(self._counter)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "users": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+
+user_cache = UserCache(ttl=CACHE_TTL if CACHE_USER_AFFINE else 0)
@@ -0,0 +1,120 @@
+import io
+import os
+import time
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from aiogram.types import BufferedInputFile
+
+from analytics import (
+    PERIOD_NAMES, TREND_DAYS, MOVING_AVERAGE_DAYS, Columns, category_breakdown,
+    load_rows, moving_average, period_start, series
+)
+from cache import user_cache, CACHE_USER_AFFINE
+
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", 2))
+CHART_CACHE_MAX = int(os.getenv("CHART_CACHE_MAX", 5000))
+
+# Графики рисуют отдельные процессы: matplotlib держит GIL по сотне миллисекунд,
+# а цикл событий в это время должен разбирать обновления
+_pool = None
+# (user_id, период, день, поколение данных в кэше) -> file_id уже загруженной картинки.
+# Поколение локальное для процесса, поэтому без CACHE_USER_AFFINE картинки не переиспользуются
+_file_ids = OrderedDict()
+stats = {"hits": 0, "renders": 0, "render_seconds": 0.0}
+
+
+def render_chart(title, labels, daily, average, breakdown):
+    # Выполняется в процессе пула: на входе только простые типы, на выходе PNG
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 7), dpi=100)
+    top, bottom = fig.subplots(2, 1, gridspec_kw={"height_ratios": [3, 2]})
+    x = np.arange(len(daily))
+    top.bar(x, daily, color="#e57373", label="Расходы за день")
+    if len(average):
+        top.plot(x[len(x) - len(average):], average, color="#1e88e5", linewidth=2,
+                 label=f"Среднее за {MOVING_AVERAGE_DAYS} дн.")
+    top.set_xticks(x[::5], labels[::5])
+    top.set_title(title)
+    top.legend(loc="upper left")
+    if breakdown:
+        names, amounts = zip(*breakdown)
+        bottom.barh(names[::-1], amounts[::-1], color="#ffb74d")
+    bottom.set_title("Расходы по категориям")
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+def _warm():
+    import matplotlib.figure
+
+
+def _chart_args(rows, now, period):
+    cols = Columns(rows)
+    today = period_start(now, "day")
+    start = today - timedelta(days=TREND_DAYS - 1)
+    daily = series(cols, int(start.timestamp()), 24 * 3600, TREND_DAYS)
+    _, breakdown = category_breakdown(cols, int(period_start(now, period).timestamp()))
+    labels = [(start + timedelta(days=i)).strftime("%d.%m") for i in range(TREND_DAYS)]
+    return (
+        f"Расходы за {TREND_DAYS} дн., категории за {PERIOD_NAMES[period]}",
+        labels, daily.tolist(), moving_average(daily).tolist(),
+        [(str(name), float(amount)) for name, amount in breakdown],
+    )
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn, а не fork: у процесса бота уже есть потоки (пул соединений, aiosqlite)
+        _pool = ProcessPoolExecutor(CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def start_charts():
+    # Поднимаем процессы и импортируем matplotlib заранее, чтобы первый график не ждал их
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    await asyncio.gather(*(loop.run_in_executor(pool, _warm) for _ in range(CHART_WORKERS)))
+
+
+async def close_charts():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+
+async def send_chart(bot, chat_id, user_id, period):
+    if period not in PERIOD_NAMES:
+        period = "month"
+    now = datetime.now(timezone.utc)
+    # Поколение меняется при каждой записи пользователя — это и есть версия данных
+    key = (user_id, period, now.date().isoformat(), user_cache.generation(user_id))
+    file_id = _file_ids.get(key) if CACHE_USER_AFFINE else None
+    if file_id is not None:
+        _file_ids.move_to_end(key)
+        stats["hits"] += 1
+        await bot.send_photo(chat_id, file_id)
+        return
+    rows = await load_rows(user_id, now)
+    args = await asyncio.to_thread(_chart_args, rows, now, period)
+    started = time.perf_counter()
+    png = await asyncio.get_running_loop().run_in_executor(_get_pool(), render_chart, *args)
+    stats["renders"] += 1
+    stats["render_seconds"] += time.perf_counter() - started
+    message = await bot.send_photo(chat_id, BufferedInputFile(png, "chart.png"))
+    if not CACHE_USER_AFFINE:
+        return
+    # Повторно ту же картинку не загружаем: Telegram отдаст её по file_id
+    _file_ids[key] = message.photo[-1].file_id
+    while len(_file_ids) > CHART_CACHE_MAX:
+        _file_ids.popitem(last=False)
@@ -1,265 +1,529 @@
 import os
-import psycopg2
-import aiosqlite
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+from backends import create_backend
+from cache import user_cache
+from migrations import migrate
+from writer import WRITE_BEHIND, BatchWriter
 
 IS_RENDER = os.getenv("RENDER") is not None
 DATABASE_URL = os.getenv("DATABASE_URL")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "finance.db")
+
+PERIODS = ("day", "week", "month", "year")
+# Месяцы старше этого уходят в архив (transactions_archive). Не меньше года:
+# отчёты analytics.py читают операции с начала года и за окно тренда
+ARCHIVE_AFTER_MONTHS = max(int(os.getenv("ARCHIVE_AFTER_MONTHS", 13)), 12)
+# Секции Postgres создаются на текущий месяц и столько следующих
+PARTITIONS_AHEAD = int(os.getenv("PARTITIONS_AHEAD", 2))
+# Начала месяцев, секции которых этот процесс уже создал или видел (Postgres)
+_partitioned = set()
+# Верхняя граница живых строк последней страницы экспорта
+_EXPORT_END = datetime(9999, 1, 1, tzinfo=timezone.utc)
+
+# Бэкенд выбирается один раз при старте: Postgres на Render, SQLite локально
+_backend = None
+# Буфер групповой записи операций (WRITE_BEHIND=1), иначе каждая запись — своя транзакция
+_writer = None
+
+
+async def open_db():
+    global _backend, _writer
+    if _backend is None:
+        backend = create_backend(DATABASE_URL if IS_RENDER else None, SQLITE_PATH)
+        await backend.open()
+        _backend = backend
+    if WRITE_BEHIND and _writer is None:
+        _writer = BatchWriter(add_transactions)
+        _writer.start()
+
+
+async def close_db():
+    global _backend, _writer
+    if _writer is not None:
+        # Сначала дописываем накопленное, пока соединения ещё открыты
+        writer, _writer = _writer, None
+        await writer.stop()
+    if _backend is not None:
+        backend, _backend = _backend, None
+        await backend.close()
+
+
+def db_stats():
+    # Для /metrics: соединения бэкенда и очередь буфера записи
+    stats = dict(_backend.stats()) if _backend is not None else {}
+    if _writer is not None:
+        stats["write_pending"] = _writer.pending
+    return stats
+
+
+@asynccontextmanager
+async def get_db():
+    if _backend is None:
+        await open_db()
+    async with _backend.session() as db:
+        yield db
 
-@contextmanager
-def get_db():
-    conn = None
-    try:
-        if IS_RENDER and DATABASE_URL:
-            conn = psycopg2.connect(DATABASE_URL)
-            yield conn
-        else:
-            conn = aiosqlite.connect("finance.db")
-            yield conn
-    finally:
-        if conn:
-            conn.close()
 
 async def init_db():
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    goal_amount DOUBLE PRECISION DEFAULT 0,
-                    goal_end_date DATE
-                )
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    type VARCHAR(10),
-                    amount DOUBLE PRECISION,
-                    category TEXT,
-                    created_at TIMESTAMPTZ DEFAULT NOW()
-                )
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS todos (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    text TEXT,
-                    is_done BOOLEAN DEFAULT FALSE,
-                    due_date DATE
-                )
-            """)
-
-            # МИГРАЦИЯ: добавляем столбец due_date, если его нет
-            try:
-                cur.execute("SELECT due_date FROM todos LIMIT 1")
-            except psycopg2.errors.UndefinedColumn:
-                try:
-                    cur.execute("ALTER TABLE todos ADD COLUMN due_date DATE")
-                    print("✅ Добавлен столбец due_date в todos")
-                except Exception as e:
-                    print(f"❌ Ошибка при добавлении due_date: {e}")
-
-            conn.commit()
-        else:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    goal_amount REAL DEFAULT 0,
-                    goal_end_date TEXT
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    type TEXT,
-                    amount REAL,
-                    category TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS todos (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    text TEXT,
-                    is_done BOOLEAN DEFAULT 0,
-                    due_date TEXT
-                )
-            """)
-            await conn.commit()
-
-async def add_transaction(user_id, t_type, amount, category):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO transactions (user_id, type, amount, category) VALUES (%s, %s, %s, %s)",
-                (user_id, t_type, amount, category)
-            )
-            conn.commit()
-        else:
-            await conn.execute(
-                "INSERT INTO transactions (user_id, type, amount, category) VALUES (?, ?, ?, ?)",
-                (user_id, t_type, amount, category)
-            )
-            await conn.commit()
+    async with get_db() as db:
+        applied = await migrate(db, _backend.dialect)
+    await ensure_partitions()
+    return applied
+
+def period_buckets(moment):
+    # Ключи корзин (UTC) для момента времени; должны совпадать с _BUCKETS в queries.py
+    moment = moment.astimezone(timezone.utc)
+    day = moment.date()
+    return {
+        "day": day.isoformat(),
+        "week": (day - timedelta(days=day.weekday())).isoformat(),
+        "month": moment.strftime("%Y-%m"),
+        "year": moment.strftime("%Y"),
+    }
+
+def _add_months(moment, months):
+    # Начало месяца, отстоящего от moment на months (UTC)
+    index = moment.year * 12 + moment.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+def _month_bounds(month):
+    # 'ГГГГ-ММ' (корзина month в rollups) -> [начало, начало следующего) в формате бэкенда
+    start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    return _backend.timestamp(start), _backend.timestamp(_add_months(start, 1))
+
+def _totals_delta(t_type, amount):
+    # (баланс, доход, расход) — на сколько меняются итоги пользователя
+    if t_type == "income":
+        return amount, amount, 0.0
+    return -amount, 0.0, amount
+
+async def _cached(user_id, key, load):
+    # Чтение через кэш: при промахе грузим из базы и кладём, если никто не успел записать
+    found, value = user_cache.get(user_id, key)
+    if found:
+        return value
+    generation = user_cache.generation(user_id)
+    value = await load()
+    user_cache.set(user_id, key, value, generation)
+    return value
+
+async def add_transactions(rows):
+    # rows: (user_id, type, amount, category, created_at). Всё одной транзакцией:
+    # сами операции, итоги и свёртки, причём дельты итогов и свёрток
+    # предварительно суммируются, чтобы обновить каждую строку один раз
+    totals = {}
+    rollups = {}
+    for user_id, t_type, amount, _, created_at in rows:
+        delta = _totals_delta(t_type, amount)
+        current = totals.get(user_id, (0.0, 0.0, 0.0))
+        totals[user_id] = tuple(a + b for a, b in zip(current, delta))
+        for period, bucket in period_buckets(created_at).items():
+            income, expense = rollups.get((user_id, period, bucket), (0.0, 0.0))
+            rollups[(user_id, period, bucket)] = (income + delta[1], expense + delta[2])
+    async with get_db() as db:
+        await db.executemany("add_transaction", [
+            (user_id, t_type, amount, category, _backend.timestamp(created_at))
+            for user_id, t_type, amount, category, created_at in rows
+        ])
+        await db.executemany("totals_add", [(user_id, *delta) for user_id, delta in totals.items()])
+        await db.executemany("rollup_add", [(*key, *sums) for key, sums in rollups.items()])
+        await db.commit()
+    for user_id in totals:
+        user_cache.invalidate(user_id)
+
+async def add_transaction(user_id, t_type, amount, category, created_at=None):
+    if created_at is not None:
+        # Операция задним числом: её месяца может не быть среди секций
+        await _ensure_months([created_at])
+    row = (user_id, t_type, amount, category, created_at or datetime.now(timezone.utc))
+    if _writer is not None:
+        # Ответ пользователю уйдёт только после коммита пачки, в которую попала запись
+        await _writer.submit(row)
+    else:
+        await add_transactions([row])
+
+# 📥 Импорт и экспорт. Импорт пишет операции пачками в обход итогов и свёрток,
+# поэтому после загрузки их нужно пересчитать через finish_import()
+async def import_transactions(rows):
+    await _ensure_months(created_at for *_, created_at in rows)
+    async with get_db() as db:
+        await db.copy("transactions_copy", [
+            (user_id, t_type, amount, category, _backend.timestamp(created_at))
+            for user_id, t_type, amount, category, created_at in rows
+        ])
+        await db.commit()
+
+async def finish_import(user_id):
+    await rebuild_totals(user_id)
+    await rebuild_rollups(user_id)
+
+async def export_transactions(user_id, batch=1000):
+    # Строки (created_at, type, amount, category) пачками по batch, без загрузки всей истории в память.
+    # Сессия держится только на время одной пачки: пока вызывающий пишет файл, база свободна
+    # (у SQLite одно соединение на всех, у Postgres — соединение пула).
+    # Архивные месяцы идут по одному: floor — месяц, раньше которого архив уже выгружен
+    after = None
+    floor = ""
+    while True:
+        async with get_db() as db:
+            key_month = _as_utc(after[0]).strftime("%Y-%m") if after else ""
+            months = [r[0] for r in await db.fetchall("archive_months_from", (user_id, max(key_month, floor)))]
+            month = months[0] if months else ""
+            # Живые строки — до начала следующего архивного месяца, его строки ещё впереди
+            until = _month_bounds(months[1])[0] if len(months) > 1 else _backend.timestamp(_EXPORT_END)
+            if after is None:
+                rows = await db.fetchall("export_transactions_first",
+                                         (user_id, until, batch, user_id, month, batch))
+            else:
+                rows = await db.fetchall("export_transactions_after",
+                                         (user_id, *after, until, batch, user_id, month, *after, batch))
+        if rows:
+            after = rows[-1][0], rows[-1][4]
+            yield [tuple(r[:4]) for r in rows]
+        if len(rows) < batch:
+            if len(months) < 2:
+                return
+            # Всё до следующего архивного месяца выгружено — переходим к нему
+            floor = months[1]
 
 async def set_goal(user_id, amount, end_date):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute(
-                "UPDATE users SET goal_amount = %s, goal_end_date = %s WHERE user_id = %s",
-                (amount, end_date, user_id)
-            )
-            conn.commit()
-        else:
-            await conn.execute(
-                "UPDATE users SET goal_amount = ?, goal_end_date = ? WHERE user_id = ?",
-                (amount, end_date, user_id)
-            )
-            await conn.commit()
+    async with get_db() as db:
+        await db.execute("set_goal", (user_id, amount, end_date))
+        await db.commit()
+    user_cache.invalidate(user_id)
 
 async def clear_goal(user_id):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute(
-                "UPDATE users SET goal_amount = 0, goal_end_date = NULL WHERE user_id = %s",
-                (user_id,)
-            )
-            conn.commit()
-        else:
-            await conn.execute(
-                "UPDATE users SET goal_amount = 0, goal_end_date = NULL WHERE user_id = ?",
-                (user_id,)
-            )
-            await conn.commit()
+    async with get_db() as db:
+        await db.execute("clear_goal", (user_id,))
+        await db.commit()
+    user_cache.invalidate(user_id)
 
 async def clear_all(user_id):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM transactions WHERE user_id = %s", (user_id,))
-            cur.execute("UPDATE users SET goal_amount = 0, goal_end_date = NULL WHERE user_id = %s", (user_id,))
-            cur.execute("DELETE FROM todos WHERE user_id = %s", (user_id,))
-            conn.commit()
-        else:
-            await conn.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
-            await conn.execute("UPDATE users SET goal_amount = 0, goal_end_date = NULL WHERE user_id = ?", (user_id,))
-            await conn.execute("DELETE FROM todos WHERE user_id = ?", (user_id,))
-            await conn.commit()
+    # Операции удаляются помесячно по списку месяцев из rollups, а не поиском по всей истории
+    async with get_db() as db:
+        months = [row[0] for row in await db.fetchall("user_months", (user_id,))]
+        await db.executemany("delete_transactions_range", [
+            (user_id, *_month_bounds(month)) for month in months
+        ])
+        await db.execute("delete_archive", (user_id,))
+        await db.execute("totals_reset", (user_id,))
+        await db.execute("rollups_reset", (user_id,))
+        await db.execute("clear_goal", (user_id,))
+        await db.execute("delete_todos", (user_id,))
+        await db.commit()
+    user_cache.invalidate(user_id)
 
 async def get_user_goal(user_id):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("SELECT goal_amount, goal_end_date FROM users WHERE user_id = %s", (user_id,))
-            row = cur.fetchone()
-            return (row[0], row[1]) if row else (0, None)
-        else:
-            cursor = await conn.execute("SELECT goal_amount, goal_end_date FROM users WHERE user_id = ?", (user_id,))
-            row = await cursor.fetchone()
+    async def load():
+        async with get_db() as db:
+            row = await db.fetchone("get_user_goal", (user_id,))
             return (row[0], row[1]) if row else (0, None)
+    return await _cached(user_id, "goal", load)
+
+async def get_totals(user_id):
+    async def load():
+        async with get_db() as db:
+            row = await db.fetchone("get_totals", (user_id,))
+            return (row[0], row[1], row[2]) if row else (0.0, 0.0, 0.0)
+    return await _cached(user_id, "totals", load)
 
 async def get_balance(user_id):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT 
-                    COALESCE(SUM(CASE WHEN type='income' THEN amount ELSE 0 END), 0) -
-                    COALESCE(SUM(CASE WHEN type='expense' THEN amount ELSE 0 END), 0)
-                FROM transactions WHERE user_id = %s
-            """, (user_id,))
-            return (cur.fetchone()[0] or 0.0)
-        else:
-            cursor = await conn.execute("""
-                SELECT 
-                    COALESCE(SUM(CASE WHEN type='income' THEN amount ELSE 0 END), 0) -
-                    COALESCE(SUM(CASE WHEN type='expense' THEN amount ELSE 0 END), 0)
-                FROM transactions WHERE user_id = ?
-            """, (user_id,))
-            row = await cursor.fetchone()
-            return row[0] if row else 0.0
+    balance, _, _ = await get_totals(user_id)
+    return balance
 
 async def get_income(user_id):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = %s AND type = 'income'", (user_id,))
-            return (cur.fetchone()[0] or 0.0)
-        else:
-            cursor = await conn.execute("SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = ? AND type = 'income'", (user_id,))
-            row = await cursor.fetchone()
-            return row[0] if row else 0.0
+    _, income, _ = await get_totals(user_id)
+    return income
+
+async def get_period_totals(user_id, period):
+    if period not in PERIODS:
+        period = "year"
+    bucket = period_buckets(datetime.now(timezone.utc))[period]
+    async def load():
+        async with get_db() as db:
+            row = await db.fetchone("rollup_get", (user_id, period, bucket))
+            return (row[0], row[1]) if row else (0.0, 0.0)
+    return await _cached(user_id, ("period", period, bucket), load)
 
 async def get_expenses_by_period(user_id, period):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            if period == "day":
-                where = "DATE(created_at) = CURRENT_DATE"
-            elif period == "week":
-                where = "created_at >= DATE_TRUNC('week', NOW())"
-            elif period == "month":
-                where = "DATE_TRUNC('month', created_at) = DATE_TRUNC('month', NOW())"
-            else:  # year
-                where = "EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM NOW())"
-            cur.execute(f"SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = %s AND type = 'expense' AND {where}", (user_id,))
-            return (cur.fetchone()[0] or 0.0)
-        else:
-            if period == "day":
-                where = "DATE(created_at) = DATE('now')"
-            elif period == "week":
-                where = "strftime('%W', created_at) = strftime('%W', 'now') AND strftime('%Y', created_at) = strftime('%Y', 'now')"
-            elif period == "month":
-                where = "strftime('%Y-%m', created_at) = strftime('%Y-%m', 'now')"
-            else:  # year
-                where = "strftime('%Y', created_at) = strftime('%Y', 'now')"
-            cursor = await conn.execute(f"SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = ? AND type = 'expense' AND {where}", (user_id,))
-            row = await cursor.fetchone()
-            return row[0] if row else 0.0
+    _, expense = await get_period_totals(user_id, period)
+    return expense
+
+async def get_stats_snapshot(user_id, period):
+    # (доходы за период, расходы за период, общий баланс)
+    if period not in PERIODS:
+        period = "year"
+    bucket = period_buckets(datetime.now(timezone.utc))[period]
+    async def load():
+        async with get_db() as db:
+            row = await db.fetchone("stats_snapshot", (user_id, period, bucket))
+            return (row[0], row[1], row[2]) if row else (0.0, 0.0, 0.0)
+    return await _cached(user_id, ("snapshot", period, bucket), load)
+
+async def get_stats_all_periods(user_id):
+    # (общий баланс, {период: (доходы, расходы)}) для всех периодов сразу
+    buckets = period_buckets(datetime.now(timezone.utc))
+    async def load():
+        async with get_db() as db:
+            rows = await db.fetchall("stats_all_periods", (user_id, *(buckets[p] for p in PERIODS)))
+        periods = {period: (0.0, 0.0) for period in PERIODS}
+        balance = 0.0
+        for row_balance, period, income, expense in rows:
+            balance = row_balance
+            if period is not None:
+                periods[period] = (income, expense)
+        return balance, periods
+    balance, periods = await _cached(user_id, ("all_periods", buckets["day"]), load)
+    return balance, dict(periods)
+
+async def get_analytics_rows(user_id, since):
+    # (время UTC в секундах, расход ли, сумма, категория) с момента since. Не кэшируется:
+    # в кэш кладётся уже посчитанный отчёт (analytics.py)
+    async with get_db() as db:
+        return await db.fetchall("analytics_transactions", (user_id, _backend.timestamp(since)))
 
 async def add_todo(user_id, text, due_date=None):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("INSERT INTO todos (user_id, text, due_date) VALUES (%s, %s, %s)", (user_id, text, due_date))
-            conn.commit()
-        else:
-            await conn.execute("INSERT INTO todos (user_id, text, due_date) VALUES (?, ?, ?)", (user_id, text, due_date))
-            await conn.commit()
+    async with get_db() as db:
+        await db.execute("add_todo", (user_id, text, due_date))
+        await db.commit()
+    user_cache.invalidate(user_id)
 
 async def get_todos(user_id):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("SELECT id, text, is_done, due_date FROM todos WHERE user_id = %s", (user_id,))
-            return [(r[0], r[1], r[2], r[3]) for r in cur.fetchall()]
-        else:
-            cursor = await conn.execute("SELECT id, text, is_done, due_date FROM todos WHERE user_id = ?", (user_id,))
-            return await cursor.fetchall()
-
-async def delete_todo(todo_id):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM todos WHERE id = %s", (todo_id,))
-            conn.commit()
+    async def load():
+        async with get_db() as db:
+            return tuple(tuple(r) for r in await db.fetchall("get_todos", (user_id,)))
+    return list(await _cached(user_id, "todos", load))
+
+async def get_todos_page(user_id, after_id=None, limit=10, before_id=None):
+    # Страница задач по ключу: (задачи, есть ли предыдущая, есть ли следующая).
+    # Берём на одну строку больше, чтобы узнать, есть ли что-то дальше
+    async def load():
+        async with get_db() as db:
+            if before_id is not None:
+                rows = await db.fetchall("todos_page_before", (user_id, before_id, limit + 1))
+                return tuple(tuple(r) for r in reversed(rows[:limit])), len(rows) > limit, True
+            if after_id is not None:
+                rows = await db.fetchall("todos_page_after", (user_id, after_id, limit + 1))
+                return tuple(tuple(r) for r in rows[:limit]), True, len(rows) > limit
+            rows = await db.fetchall("todos_page_first", (user_id, limit + 1))
+            return tuple(tuple(r) for r in rows[:limit]), False, len(rows) > limit
+    todos, has_prev, has_next = await _cached(user_id, ("todos_page", after_id, before_id, limit), load)
+    return list(todos), has_prev, has_next
+
+async def get_todo(user_id, todo_id):
+    async def load():
+        async with get_db() as db:
+            row = await db.fetchone("get_todo", (user_id, todo_id))
+            return tuple(row) if row else None
+    return await _cached(user_id, ("todo", todo_id), load)
+
+async def delete_todo(user_id, todo_id):
+    async with get_db() as db:
+        await db.execute("delete_todo", (todo_id, user_id))
+        await db.commit()
+    user_cache.invalidate(user_id)
+
+async def complete_todo(user_id, todo_id):
+    async with get_db() as db:
+        await db.execute("complete_todo", (todo_id, user_id))
+        await db.commit()
+    user_cache.invalidate(user_id)
+
+def _forget(user_id=None):
+    if user_id is None:
+        user_cache.clear()
+    else:
+        user_cache.invalidate(user_id)
+
+# ⏰ Напоминания: строки помечаются в базе до отправки, поэтому перезапуск
+# не приводит к повторной рассылке, а неудачные отправки возвращаются в очередь
+async def claim_due_todos(day, since, limit):
+    # Срок — от since до day включительно: задачи, пропущенные из-за простоя
+    # или неудачной отправки, напоминаются с опозданием, но не бесконечно давно
+    async with get_db() as db:
+        rows = await db.fetchall("todos_claim_due", (day.isoformat(), day.isoformat(), since.isoformat(), limit))
+        await db.commit()
+        return [tuple(r) for r in rows]
+
+async def unclaim_todos(todo_ids):
+    if not todo_ids:
+        return
+    async with get_db() as db:
+        await db.executemany("todo_unclaim", [(todo_id,) for todo_id in todo_ids])
+        await db.commit()
+
+async def claim_due_goals(day, until, limit):
+    async with get_db() as db:
+        rows = await db.fetchall("goals_claim_due", (day.isoformat(), day.isoformat(), until.isoformat(), limit))
+        await db.commit()
+        return [tuple(r) for r in rows]
+
+async def unclaim_goals(user_ids):
+    if not user_ids:
+        return
+    async with get_db() as db:
+        await db.executemany("goal_unclaim", [(user_id,) for user_id in user_ids])
+        await db.commit()
+
+# 🗄 Секции и архив. Горячие месяцы лежат в transactions (в Postgres — секция на месяц),
+# старые сворачиваются в transactions_archive; суммы по ним по-прежнему в rollups
+async def ensure_partitions(now=None):
+    # Секции на текущий и PARTITIONS_AHEAD следующих месяцев, а также на месяцы, строки которых
+    # попали в DEFAULT (записаны в другом процессе или до архивации) — они переезжают в свою секцию
+    if _backend.dialect != "postgres":
+        return
+    month = _add_months(now or datetime.now(timezone.utc), 0)
+    months = {_add_months(month, i) for i in range(PARTITIONS_AHEAD + 1)}
+    async with get_db() as db:
+        months.update(_as_utc(r[0]) for r in await db.fetchall("default_months"))
+        await db.executemany("ensure_partition", [(m, _add_months(m, 1)) for m in sorted(months)])
+        await db.commit()
+    _partitioned.update(months)
+
+async def _ensure_months(moments):
+    # Секции для месяцев, в которые сейчас будет запись, чтобы строки не оседали в DEFAULT.
+    # Уже созданные этим процессом месяцы запоминаются, повторно функцию не вызываем
+    if _backend.dialect != "postgres":
+        return
+    missing = {_add_months(_as_utc(moment).astimezone(timezone.utc), 0) for moment in moments} - _partitioned
+    if not missing:
+        return
+    async with get_db() as db:
+        await db.executemany("ensure_partition", [(m, _add_months(m, 1)) for m in sorted(missing)])
+        await db.commit()
+    _partitioned.update(missing)
+
+def _as_utc(value):
+    # MIN(created_at): datetime в Postgres, строка 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' (UTC) в SQLite
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+async def archive_old_months(now=None):
+    # Переносит в архив месяцы старше ARCHIVE_AFTER_MONTHS, по месяцу за транзакцию.
+    # Возвращает список перенесённых месяцев
+    cutoff = _add_months(now or datetime.now(timezone.utc), -ARCHIVE_AFTER_MONTHS)
+    archived = []
+    while True:
+        async with get_db() as db:
+            oldest = (await db.fetchone("transactions_oldest"))[0]
+            if oldest is None or _as_utc(oldest) >= cutoff:
+                break
+            month = _as_utc(oldest).strftime("%Y-%m")
+            if month in archived:
+                raise RuntimeError(f"Месяц {month} не удалился из transactions после архивации")
+            start, end = _month_bounds(month)
+            await db.execute("archive_month", (month, start, end))
+            await db.execute("archive_drop_month", (start, end))
+            await db.commit()
+        # Секция месяца удалена: запись в него задним числом должна создать её заново
+        _partitioned.discard(_add_months(_as_utc(oldest), 0))
+        archived.append(month)
+    return archived
+
+# 🔧 Обслуживание итогов: пересчёт из истории (transactions и архив) и поиск расхождений
+async def rebuild_totals(user_id=None):
+    async with get_db() as db:
+        if user_id is None:
+            await db.execute("totals_reset_all")
+            await db.execute("totals_rebuild_all_history")
         else:
-            await conn.execute("DELETE FROM todos WHERE id = ?", (todo_id,))
-            await conn.commit()
-
-async def toggle_todo(todo_id):
-    with get_db() as conn:
-        if IS_RENDER and DATABASE_URL:
-            cur = conn.cursor()
-            cur.execute("UPDATE todos SET is_done = NOT is_done WHERE id = %s", (todo_id,))
-            conn.commit()
+            await db.execute("totals_reset", (user_id,))
+            await db.execute("totals_rebuild", (user_id,))
+        await db.commit()
+    _forget(user_id)
+
+async def verify_totals(tolerance=0.005):
+    async with get_db() as db:
+        expected = {r[0]: (r[1], r[2]) for r in await db.fetchall("totals_from_transactions")}
+        stored = {r[0]: (r[1], r[2], r[3]) for r in await db.fetchall("totals_all")}
+    drift = []
+    for user_id in expected.keys() | stored.keys():
+        exp_income, exp_expense = expected.get(user_id, (0.0, 0.0))
+        got_income, got_expense, got_balance = stored.get(user_id, (0.0, 0.0, 0.0))
+        if (abs(exp_income - got_income) > tolerance or abs(exp_expense - got_expense) > tolerance
+                or abs(exp_income - exp_expense - got_balance) > tolerance):
+            drift.append((user_id, (exp_income, exp_expense), (got_income, got_expense, got_balance)))
+    return drift
+
+
+# 🔧 Обслуживание свёрток по периодам
+async def rebuild_rollups(user_id=None):
+    async with get_db() as db:
+        if user_id is None:
+            await db.execute("rollups_reset_all")
+            for period in PERIODS:
+                await db.execute(f"rollup_rebuild_{period}_all_history")
         else:
-            await conn.execute("UPDATE todos SET is_done = NOT is_done WHERE id = ?", (todo_id,))
-            await conn.commit()
\ No newline at end of file
+            await db.execute("rollups_reset", (user_id,))
+            for period in PERIODS:
+                await db.execute(f"rollup_rebuild_{period}", (user_id,))
+        await db.commit()
+    _forget(user_id)
+
+async def verify_rollups(tolerance=0.005):
+    async with get_db() as db:
+        expected = {}
+        for period in PERIODS:
+            for user_id, _, bucket, income, expense in await db.fetchall(f"rollup_expected_{period}"):
+                expected[(user_id, period, bucket)] = (income, expense)
+        stored = {(r[0], r[1], r[2]): (r[3], r[4]) for r in await db.fetchall("rollups_all")}
+    drift = []
+    for key in expected.keys() | stored.keys():
+        exp_income, exp_expense = expected.get(key, (0.0, 0.0))
+        got_income, got_expense = stored.get(key, (0.0, 0.0))
+        if abs(exp_income - got_income) > tolerance or abs(exp_expense - got_expense) > tolerance:
+            drift.append((key, (exp_income, exp_expense), (got_income, got_expense)))
+    return drift
+
+
+async def _cli(args):
+    await open_db()
+    try:
+        await init_db()
+        if args.command == "migrate":
+            return 0
+        if args.command == "verify-totals":
+            drift = await verify_totals()
+            for user_id, expected, stored in drift:
+                print(f"❌ {user_id}: по транзакциям доход/расход {expected}, в итогах доход/расход/баланс {stored}")
+            print("✅ Итоги сходятся" if not drift else f"Расхождений: {len(drift)}")
+            return 1 if drift else 0
+        if args.command == "rebuild-totals":
+            await rebuild_totals(args.user)
+            print("✅ Итоги пересчитаны")
+        if args.command == "verify-rollups":
+            drift = await verify_rollups()
+            for (user_id, period, bucket), expected, stored in drift:
+                print(f"❌ {user_id} {period} {bucket}: по транзакциям {expected}, в свёртке {stored}")
+            print("✅ Свёртки сходятся" if not drift else f"Расхождений: {len(drift)}")
+            return 1 if drift else 0
+        if args.command == "backfill-rollups":
+            await rebuild_rollups(args.user)
+            print("✅ Свёртки пересчитаны")
+        if args.command == "archive":
+            months = await archive_old_months()
+            print(f"✅ В архиве: {', '.join(months)}" if months else "✅ Архивировать нечего")
+        return 0
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import sys
+
+    parser = argparse.ArgumentParser(description="Обслуживание базы финансового бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="применить новые миграции схемы")
+    commands.add_parser("verify-totals", help="сверить итоги с историей операций")
+    rebuild = commands.add_parser("rebuild-totals", help="пересчитать итоги из истории операций")
+    rebuild.add_argument("--user", type=int, help="только для одного пользователя")
+    commands.add_parser("verify-rollups", help="сверить свёртки по периодам с историей операций")
+    backfill = commands.add_parser("backfill-rollups", help="пересчитать свёртки из истории операций")
+    backfill.add_argument("--user", type=int, help="только для одного пользователя")
+    commands.add_parser("archive", help=f"перенести в архив месяцы старше {ARCHIVE_AFTER_MONTHS}")
+    sys.exit(asyncio.run(_cli(parser.parse_args())))
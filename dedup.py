@@ -0,0 +1,118 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+
+DEDUP_MAX_UPDATES = int(os.getenv("DEDUP_MAX_UPDATES", 100000))
+DEDUP_UPDATE_TTL = float(os.getenv("DEDUP_UPDATE_TTL", 3600))  # Telegram повторяет доставку до часа
+DEDUP_TAP_WINDOW = float(os.getenv("DEDUP_TAP_WINDOW", 1.5))  # повторное нажатие той же кнопки
+
+
+# Ключи с истечением. TTL у всех одинаковый, поэтому порядок добавления — это и порядок
+# истечения: протухшие и лишние сверх max_size снимаются с начала
+class ExpiringMap:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()  # ключ -> (истекает в, значение)
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None or item[0] <= time.monotonic():
+            return None
+        return item[1]
+
+    def set(self, key, value):
+        now = time.monotonic()
+        self._items[key] = (now + self.ttl, value)
+        self._items.move_to_end(key)
+        while self._items and (
+            len(self._items) > self.max_size or next(iter(self._items.values()))[0] <= now
+        ):
+            self._items.popitem(last=False)
+
+
+class ExpiringSet(ExpiringMap):
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def add(self, key):
+        self.set(key, True)
+
+
+# Внешний middleware на dp.update, стоит раньше FSM: повтор не доходит ни до чтения
+# состояния, ни до обработчика, то есть не делает ни одного запроса к базе.
+#  - Повторно доставленное обновление (тот же update_id) отбрасывается.
+#  - Одинаковые нажатия — та же кнопка того же сообщения в той же редакции — выполняются
+#    один раз: пока первое в работе и ещё DEDUP_TAP_WINDOW секунд после него остальные
+#    только гасят «часики» на кнопке. edit_date у Telegram в целых секундах, и после
+#    «Назад» сообщение может вернуться в прежний вид в ту же секунду, поэтому повтором
+#    считается только нажатие той же кнопки, что и последнее выполненное в этом сообщении
+class UpdateDedup(BaseMiddleware):
+    def __init__(self, max_updates=DEDUP_MAX_UPDATES, update_ttl=DEDUP_UPDATE_TTL, tap_window=DEDUP_TAP_WINDOW):
+        self._updates = ExpiringSet(update_ttl, max_updates)
+        self._recent_taps = ExpiringMap(tap_window, max_updates)  # сообщение -> последняя кнопка
+        self._taps = {}  # ключ нажатия -> Future, завершается вместе с первым нажатием
+        self.duplicates = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _message_key(callback):
+        message = callback.message
+        if message is None:
+            return callback.from_user.id, callback.inline_message_id, None
+        return callback.from_user.id, message.message_id, getattr(message, "edit_date", None)
+
+    async def __call__(self, handler, event, data):
+        if event.update_id in self._updates:
+            self.duplicates += 1
+            return None
+        self._updates.add(event.update_id)
+
+        callback = event.callback_query
+        if callback is None:
+            return await handler(event, data)
+        message_key = self._message_key(callback)
+        key = message_key + (callback.data,)
+        leader = self._taps.get(key)
+        if leader is not None or self._recent_taps.get(message_key) == callback.data:
+            self.coalesced += 1
+            if leader is not None:
+                # Ответ на повтор — когда первое нажатие уже отработало
+                await asyncio.wait((leader,))
+            try:
+                await callback.answer()
+            except TelegramAPIError:
+                pass
+            return None
+
+        leader = self._taps[key] = asyncio.get_running_loop().create_future()
+        try:
+            return await handler(event, data)
+        finally:
+            del self._taps[key]
+            leader.set_result(None)
+            self._recent_taps.set(message_key, callback.data)
+
+    def stats(self):
+        return {
+            "updates": len(self._updates),
+            "in_flight": len(self._taps),
+            "duplicates": self.duplicates,
+            "coalesced": self.coalesced,
+        }
+
+
+def setup_dedup(dp):
+    # FSMContextMiddleware регистрируется ещё в конструкторе Dispatcher и читает состояние
+    # из базы для каждого обновления, поэтому переставляем его после нашего
+    dedup = UpdateDedup()
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(dedup)
+    dp.update.outer_middleware(dp.fsm)
+    return dedup
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import asyncio
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+from database import get_db
+
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 24 * 3600))
+FSM_CLEANUP_INTERVAL = float(os.getenv("FSM_CLEANUP_INTERVAL", 600))
+FSM_CLEANUP_BATCH = int(os.getenv("FSM_CLEANUP_BATCH", 500))
+
+
+# Хранилище FSM в общей базе: состояние переживает перезапуск и видно всем
+# процессам бота. Каждая запись живёт FSM_STATE_TTL секунд с последнего изменения,
+# брошенные диалоги удаляются фоновой задачей пачками по FSM_CLEANUP_BATCH строк.
+class DatabaseStorage(BaseStorage):
+    def __init__(self, ttl=FSM_STATE_TTL):
+        self.ttl = ttl
+        self._cleanup_task = None
+
+    @staticmethod
+    def _key(key):
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny
+        ))
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        now = int(time.time())
+        async with get_db() as db:
+            if state is None:
+                await db.execute("fsm_clear_state", (self._key(key),))
+                await db.execute("fsm_delete_empty", (self._key(key),))
+            else:
+                await db.execute("fsm_set_state", (self._key(key), state, now + self.ttl, now))
+            await db.commit()
+
+    async def get_state(self, key):
+        async with get_db() as db:
+            row = await db.fetchone("fsm_get", (self._key(key), int(time.time())))
+        return row[0] if row else None
+
+    async def set_data(self, key, data):
+        now = int(time.time())
+        async with get_db() as db:
+            if not data:
+                await db.execute("fsm_clear_data", (self._key(key),))
+                await db.execute("fsm_delete_empty", (self._key(key),))
+            else:
+                payload = json.dumps(data, ensure_ascii=False)
+                await db.execute("fsm_set_data", (self._key(key), payload, now + self.ttl, now))
+            await db.commit()
+
+    async def get_data(self, key):
+        async with get_db() as db:
+            row = await db.fetchone("fsm_get", (self._key(key), int(time.time())))
+        return json.loads(row[1]) if row else {}
+
+    async def cleanup(self, batch=FSM_CLEANUP_BATCH):
+        # Короткие транзакции, чтобы не держать блокировки на всю таблицу
+        removed = 0
+        while True:
+            async with get_db() as db:
+                deleted = await db.execute("fsm_cleanup", (int(time.time()), batch))
+                await db.commit()
+            removed += max(deleted, 0)
+            if deleted < batch:
+                return removed
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(FSM_CLEANUP_INTERVAL)
+            try:
+                await self.cleanup()
+            except Exception as e:
+                print(f"❌ Ошибка очистки состояний FSM: {e}")
+
+    def start(self):
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self):
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+
+
+async def _bench(args):
+    # Задержка set/get на пользователей с отрицательными id против MemoryStorage aiogram
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from database import open_db, close_db, init_db
+
+    keys = [StorageKey(bot_id=0, chat_id=-i, user_id=-i) for i in range(1, args.users + 1)]
+    data = {"amount": 1250.5, "category": "кафе", "page": 3}
+
+    async def measure(storage, op):
+        latencies = []
+
+        async def one(key):
+            started = time.perf_counter()
+            await op(storage, key)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            await asyncio.gather(*(one(key) for key in keys))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return (len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+                latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000)
+
+    ops = {
+        "set_state": lambda s, key: s.set_state(key, "States.amount"),
+        "get_state": lambda s, key: s.get_state(key),
+        "set_data": lambda s, key: s.set_data(key, data),
+        "get_data": lambda s, key: s.get_data(key),
+    }
+    await open_db()
+    try:
+        await init_db()
+        print(f"{args.users} польз. × {args.rounds} повт., все пользователи одновременно")
+        print(f"{'хранилище':<10} {'операция':<10} {'опер./с':>9} {'p50 мс':>8} {'p99 мс':>8}")
+        for name, storage in (("memory", MemoryStorage()), ("database", DatabaseStorage())):
+            for op_name, op in ops.items():
+                throughput, p50, p99 = await measure(storage, op)
+                print(f"{name:<10} {op_name:<10} {throughput:>9,.0f} {p50:>8.3f} {p99:>8.3f}")
+            for key in keys:
+                await storage.set_state(key, None)
+                await storage.set_data(key, {})
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Замер задержки хранилища FSM против MemoryStorage")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=20)
+    asyncio.run(_bench(parser.parse_args()))
@@ -0,0 +1,447 @@
+import os
+import json
+import time
+import random
+import asyncio
+import tempfile
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+
+# Нагрузочный прогон без Telegram: настоящий Dispatcher из bot.py разбирает синтетические
+# обновления, а все запросы бота уходят в заглушку Bot API на локальном aiohttp-сервере.
+# Пример: python loadtest.py --users 50 --rounds 5; с Postgres — --backend postgres и DATABASE_URL.
+# --workers N: те же обновления через ShardRouter в 1..N процессов — как растёт пропускная способность
+LOADTEST_TOKEN = "123456:loadtest"
+LOADTEST_USER_BASE = 7_000_000_000
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadtest_baseline.json")
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+# Заглушка Bot API: отвечает как Telegram на методы, которые вызывают обработчики,
+# и помнит последнее сообщение бота в каждом чате — по его кнопкам «нажимают» пользователи
+class FakeBotAPI:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.last = {}  # chat_id -> последнее сообщение бота
+        self._message_ids = {}
+        self._runner = None
+        self.url = None
+
+    def _message(self, chat_id, text, markup=None, message_id=None):
+        edited = message_id is not None
+        if not edited:
+            message_id = self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+        message = {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": int(LOADTEST_TOKEN.split(":")[0]), "is_bot": True, "first_name": "Loadtest"},
+            "text": text or "",
+        }
+        if edited:
+            # Как у Telegram: edit_date в целых секундах, несколько правок за секунду его не меняют
+            message["edit_date"] = int(time.time())
+        if markup and "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        self.last[chat_id] = message
+        return message
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        result = True
+        if method in ("sendMessage", "sendPhoto", "sendDocument"):
+            chat_id = int(params["chat_id"])
+            result = self._message(chat_id, params.get("text") or params.get("caption"), markup)
+            if method == "sendPhoto":
+                result["photo"] = [{"file_id": f"photo{result['message_id']}", "file_unique_id": "u",
+                                    "width": 800, "height": 700}]
+        elif method == "editMessageText":
+            result = self._message(int(params["chat_id"]), params.get("text"), markup, int(params["message_id"]))
+        elif method == "getMe":
+            result = {"id": int(LOADTEST_TOKEN.split(":")[0]), "is_bot": True, "first_name": "Loadtest"}
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "Load"}
+
+
+def _message_update(update_id, user_id, message_id, text):
+    return {"update_id": update_id, "message": {
+        "message_id": message_id, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"}, "from": _user(user_id), "text": text,
+    }}
+
+
+# Пользователь шлёт обновления строго по одному, как в одном чате Telegram,
+# и кнопки берёт из последнего ответа бота
+class VirtualUser:
+    update_id = 0
+
+    def __init__(self, user_id, api, dp, bot, latencies, errors):
+        self.id = user_id
+        self.api = api
+        self.dp = dp
+        self.bot = bot
+        self.latencies = latencies
+        self.errors = errors
+        self._message_id = 0
+
+    @classmethod
+    def _next_update_id(cls):
+        cls.update_id += 1
+        return cls.update_id
+
+    async def _feed(self, data):
+        from aiogram.types import Update
+
+        update = Update.model_validate(data, context={"bot": self.bot})
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.errors.append(data)
+        self.latencies.append(time.perf_counter() - started)
+
+    def _user(self):
+        return _user(self.id)
+
+    async def send(self, text):
+        self._message_id += 1
+        await self._feed(_message_update(self._next_update_id(), self.id, self._message_id, text))
+
+    async def tap(self, prefix):
+        message = self.api.last.get(self.id)
+        buttons = [
+            button["callback_data"]
+            for row in (message or {}).get("reply_markup", {}).get("inline_keyboard", [])
+            for button in row if button.get("callback_data", "").startswith(prefix)
+        ]
+        if not buttons:
+            self.errors.append({"tap": prefix, "text": (message or {}).get("text")})
+            return
+        update_id = self._next_update_id()
+        await self._feed({"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self._user(), "chat_instance": str(self.id),
+            "message": message, "data": buttons[0],
+        }})
+
+
+async def scenario_entry(user):
+    await user.send("💰 Доход")
+    await user.send(str(random.randint(1000, 90000)))
+    await user.send("🛒 Расход")
+    await user.send(str(random.randint(50, 5000)))
+    for note in ("кофе", "такси домой", "продукты 12.10", "зарплата"):
+        await user.send(f"{random.choice('-+')}{random.randint(50, 5000)} {note}")
+    await user.send("💰 Баланс")
+
+
+async def scenario_stats(user):
+    await user.send("📈 Статистика")
+    for period in ("day", "week", "month", "year"):
+        await user.tap(f"stats:{period}")
+        await user.tap("back:stats")
+    await user.tap("stats:all")
+    await user.tap("back:stats")
+    await user.tap("stats:month")
+    await user.tap("report:")
+
+
+async def scenario_todos(user):
+    await user.send("📋 Задачи")
+    await user.tap("todo:add")
+    await user.send(f"Задача {random.randint(1, 10**6)} 15.12.2030")
+    await user.send("📋 Задачи")
+    for _ in range(2):
+        # Первое нажатие отмечает задачу, второе — удаляет выполненную
+        await user.tap("todo:select:")
+        await user.tap("todo:toggle:")
+
+
+async def scenario_goals(user):
+    await user.send("🎯 Цель")
+    await user.tap("goal:set")
+    await user.send(f"{random.randint(10, 500) * 1000} 31.12.2030")
+    await user.send("🎯 Цель")
+    await user.tap("goal:done")
+
+
+async def scenario_mixed(user):
+    for scenario in random.sample((scenario_entry, scenario_stats, scenario_todos, scenario_goals), 4):
+        await scenario(user)
+
+
+SCENARIOS = {
+    "entry": scenario_entry,
+    "stats": scenario_stats,
+    "todos": scenario_todos,
+    "goals": scenario_goals,
+    "mixed": scenario_mixed,
+}
+
+
+async def _seed(user_ids, history):
+    # История за год, чтобы статистика и отчёты читали не пустые таблицы
+    from database import import_transactions, finish_import
+
+    now = datetime.now(timezone.utc)
+    for user_id in user_ids:
+        await import_transactions([
+            (user_id, random.choice(("income", "expense", "expense")), round(random.uniform(50, 5000), 2),
+             random.choice(("еда", "кафе", "транспорт", "связь", "доход")),
+             now - timedelta(seconds=random.randint(0, 365 * 24 * 3600)))
+            for _ in range(history)
+        ])
+        await finish_import(user_id)
+
+
+def _query_counts():
+    from metrics import query_seconds
+    # Последний элемент ряда гистограммы — сумма, остальные — попадания в корзины
+    return {name: sum(series[:-1]) for name, series in query_seconds.snapshot().items()}
+
+
+async def run_scenario(name, users, rounds, api, dp, bot):
+    latencies, errors = [], []
+    vusers = [VirtualUser(user_id, api, dp, bot, latencies, errors) for user_id in users]
+    queries_before, calls_before = _query_counts(), sum(api.calls.values())
+
+    async def play(user):
+        for _ in range(rounds):
+            await SCENARIOS[name](user)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(play(user) for user in vusers))
+    elapsed = time.perf_counter() - started
+
+    queries = {
+        query: count - queries_before.get(query, 0)
+        for query, count in _query_counts().items() if count > queries_before.get(query, 0)
+    }
+    updates = max(len(latencies), 1)
+    return {
+        "updates": len(latencies),
+        "errors": len(errors),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": _percentile(latencies, 0.5) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "queries_per_update": sum(queries.values()) / updates,
+        "api_calls_per_update": (sum(api.calls.values()) - calls_before) / updates,
+        "top_queries": sorted(queries.items(), key=lambda item: -item[1])[:3],
+    }
+
+
+# Сообщения для прогона через процессы: ответ бота не нужен, чтобы отправить следующее,
+# поэтому поток обновлений заранее известен, а порядок у каждого пользователя сохраняет ShardRouter
+WORKER_STREAM = ("-350 кофе", "💰 Баланс", "+1200 подработка", "📈 Статистика", "-90 метро", "📋 Задачи")
+
+
+async def run_workers(workers, users, rounds, api):
+    from workers import ShardRouter
+
+    os.environ["BOT_WORKERS"] = str(workers)
+    router = ShardRouter(workers)
+    router.start()
+    try:
+        # Процессы импортируют бота и поднимают пулы графиков — это не часть замера.
+        # Первый отчёт процесс присылает, уже разбирая очередь
+        while len(router.worker_stats) < workers:
+            await asyncio.sleep(0.1)
+            router.stats()
+        calls_before = sum(api.calls.values())
+        updates = []
+        for round_ in range(rounds):
+            for index, text in enumerate(WORKER_STREAM):
+                for user_id in users:
+                    VirtualUser.update_id += 1
+                    updates.append(_message_update(VirtualUser.update_id, user_id,
+                                                   round_ * len(WORKER_STREAM) + index + 1, text))
+
+        started = time.perf_counter()
+        for data in updates:
+            while not router.submit(data):
+                await asyncio.sleep(0.01)
+        while True:
+            stats = router.stats()
+            if stats["processed"] + stats["failed"] >= len(updates):
+                break
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+    finally:
+        await router.stop()
+    return {
+        "updates": len(updates),
+        "errors": stats["failed"],
+        "throughput": len(updates) / elapsed,
+        "api_calls_per_update": (sum(api.calls.values()) - calls_before) / len(updates),
+    }
+
+
+def compare(result, baseline, tolerance):
+    # Список ухудшений против сохранённого замера; запросы к базе сравниваются точно
+    problems = []
+    if not baseline:
+        return problems
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        problems.append(f"пропускная способность {result['throughput']:.0f} < {baseline['throughput']:.0f}/с")
+    if result["p99_ms"] > baseline["p99_ms"] * (1 + tolerance):
+        problems.append(f"p99 {result['p99_ms']:.1f} > {baseline['p99_ms']:.1f} мс")
+    if result["queries_per_update"] > baseline["queries_per_update"] + 0.05:
+        problems.append(f"запросов на обновление {result['queries_per_update']:.2f} > {baseline['queries_per_update']:.2f}")
+    if result["errors"]:
+        problems.append(f"ошибок: {result['errors']}")
+    return problems
+
+
+def _configure(args, tmp):
+    # Всё настраивается переменными окружения, поэтому bot.py импортируется только после этого
+    os.environ["BOT_TOKEN"] = LOADTEST_TOKEN
+    os.environ["BOT_WORKERS"] = "1"
+    # Процессы отчитываются часто, иначе конец прогона --workers виден с опозданием
+    os.environ.setdefault("WORKER_STATS_INTERVAL", "0.2")
+    # Лимиты Telegram замеряются отдельно (outbox.py), здесь меряем сам бот
+    for name in ("SEND_RATE", "SEND_BURST", "SEND_CHAT_RATE", "SEND_CHAT_BURST"):
+        os.environ.setdefault(name, "1000000")
+    if args.backend == "postgres":
+        if not os.getenv("DATABASE_URL"):
+            raise SystemExit("Для --backend postgres нужен DATABASE_URL")
+        os.environ["RENDER"] = "1"
+    else:
+        os.environ.pop("RENDER", None)
+        os.environ["SQLITE_PATH"] = args.sqlite_path or os.path.join(tmp, "loadtest.db")
+
+
+async def _main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        _configure(args, tmp)
+        api = FakeBotAPI(args.api_latency / 1000)
+        await api.start()
+        os.environ["TELEGRAM_API_URL"] = api.url
+        if args.workers:
+            return await _main_workers(args, api)
+        from bot import bot, dp, storage
+        from database import open_db, close_db, init_db, clear_all
+
+        users = [LOADTEST_USER_BASE + i for i in range(args.users)]
+        results = {}
+        await open_db()
+        try:
+            await init_db()
+            await _seed(users, args.history)
+            await dp.emit_startup(bot=bot)
+            for name in args.scenarios:
+                results[name] = await run_scenario(name, users, args.rounds, api, dp, bot)
+            await dp.emit_shutdown(bot=bot)
+        finally:
+            for user_id in users:
+                await clear_all(user_id)
+            await storage.close()
+            await bot.session.close()
+            await close_db()
+            await api.stop()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baselines = json.load(f)
+    baseline = baselines.get(args.backend, {})
+
+    regressions = 0
+    print(f"{args.backend}: {args.users} польз. × {args.rounds} повт., история {args.history} операций")
+    print(f"{'сценарий':<8} {'обн.':>6} {'обн./с':>8} {'p50 мс':>8} {'p99 мс':>8} {'запр./обн.':>10} {'API/обн.':>9} {'ошиб.':>6}")
+    for name, result in results.items():
+        print(f"{name:<8} {result['updates']:>6} {result['throughput']:>8.0f} {result['p50_ms']:>8.1f} "
+              f"{result['p99_ms']:>8.1f} {result['queries_per_update']:>10.2f} {result['api_calls_per_update']:>9.2f} {result['errors']:>6}")
+        print("         чаще всего: " + ", ".join(f"{query} ×{count}" for query, count in result["top_queries"]))
+        base = baseline.get(name)
+        if base:
+            print(f"         база: {base['throughput']:.0f}/с, p99 {base['p99_ms']:.1f} мс, "
+                  f"{base['queries_per_update']:.2f} запр./обн.")
+        for problem in compare(result, base, args.tolerance):
+            print(f"         ⚠️ {problem}")
+            regressions += 1
+
+    if args.save:
+        baselines[args.backend] = {
+            name: {key: round(value, 3) for key, value in result.items() if key not in ("top_queries", "errors")}
+            for name, result in results.items()
+        }
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"💾 Замер сохранён в {args.baseline}")
+    return 1 if regressions and args.check else 0
+
+
+async def _main_workers(args, api):
+    # Бота импортируют только процессы; главный, как в bot.main(), лишь раздаёт обновления
+    from database import open_db, close_db, init_db, clear_all
+
+    users = [LOADTEST_USER_BASE + i for i in range(args.users)]
+    results = {}
+    await open_db()
+    try:
+        await init_db()
+        await _seed(users, args.history)
+        for workers in range(1, args.workers + 1):
+            results[workers] = await run_workers(workers, users, args.rounds, api)
+    finally:
+        for user_id in users:
+            await clear_all(user_id)
+        await close_db()
+        await api.stop()
+
+    print(f"{args.backend}: {args.users} польз. × {args.rounds} повт. × {len(WORKER_STREAM)} сообщ., "
+          f"ядер: {os.cpu_count()}")
+    print(f"{'процессов':<9} {'обн.':>6} {'обн./с':>8} {'ускорение':>10} {'API/обн.':>9} {'ошиб.':>6}")
+    single = results[1]["throughput"]
+    for workers, result in results.items():
+        print(f"{workers:<9} {result['updates']:>6} {result['throughput']:>8.0f} {result['throughput'] / single:>9.2f}× "
+              f"{result['api_calls_per_update']:>9.2f} {result['errors']:>6}")
+    return 1 if args.check and any(result["errors"] for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон обработчиков бота с заглушкой Bot API")
+    parser.add_argument("--backend", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--sqlite-path", help="по умолчанию — временный файл")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--history", type=int, default=500, help="операций в истории каждого пользователя")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа заглушки, мс")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое ухудшение скорости и p99")
+    parser.add_argument("--save", action="store_true", help="записать результат как новую базу")
+    parser.add_argument("--check", action="store_true", help="код выхода 1 при ухудшении")
+    parser.add_argument("--workers", type=int, nargs="?", const=os.cpu_count(), default=0,
+                        help="прогон через ShardRouter на 1..N процессах (по умолчанию N — число ядер)")
+    raise SystemExit(asyncio.run(_main(parser.parse_args())))
@@ -0,0 +1,272 @@
+import os
+import sys
+import hmac
+import time
+import bisect
+import asyncio
+import threading
+from collections import Counter as _Tally
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", 0.5))
+# Профилировщик по сэмплам включается только явно: METRICS_PROFILER=1
+METRICS_PROFILER = os.getenv("METRICS_PROFILER", "").lower() in ("1", "true", "yes")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+PROFILE_MAX_SECONDS = 60
+# /metrics и /debug/profile отдаются только с заголовком Authorization: Bearer <METRICS_TOKEN>;
+# без токена маршруты не регистрируются вовсе
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs):
+    pairs = [(name, value) for name, value in pairs if name]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+# Метрики в текстовом формате Prometheus без внешних зависимостей. У каждой
+# не больше одной метки (handler, query, ...), значения хранятся в словаре по ней;
+# обновление — одна операция со словарём, так что измерения можно не выключать
+class Metric:
+    kind = "gauge"
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def snapshot(self):
+        return dict(self.values)
+
+    def lines(self, values, extra=()):
+        for key, value in values.items():
+            yield f"{self.name}{_labels([(self.label, key), *extra])} {value}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, key="", amount=1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    def set(self, key, value):
+        self.values[key] = value
+
+    def inc(self, key="", amount=1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, key="", amount=1):
+        self.values[key] = self.values.get(key, 0) - amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = buckets
+
+    def observe(self, key, value):
+        # [число попаданий в каждую корзину..., в +Inf, сумма]
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def snapshot(self):
+        return {key: list(series) for key, series in self.values.items()}
+
+    def lines(self, values, extra=()):
+        for key, series in values.items():
+            labels = [(self.label, key), *extra]
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels([*labels, ('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_labels(labels)} {series[-1]}"
+            yield f"{self.name}_count{_labels(labels)} {cumulative}"
+
+
+class Collected(Metric):
+    # Значения снимаются функцией в момент выдачи: счётчики очередей, кэша, пула
+    def __init__(self, name, help, label, collect, kind="gauge"):
+        super().__init__(name, help, label)
+        self.kind = kind
+        self._collect = collect
+
+    def snapshot(self):
+        try:
+            return dict(self._collect())
+        except Exception:
+            return {}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def gauge(self, name, help, label=None):
+        return self._add(Gauge(name, help, label))
+
+    def histogram(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, label, buckets))
+
+    def collect(self, name, help, label, collect, kind="gauge"):
+        return self._add(Collected(name, help, label, collect, kind))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def render(self, workers=()):
+        # workers: [(номер процесса, snapshot())] — их ряды получают метку worker
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.lines(metric.snapshot()))
+            for worker, snapshot in workers:
+                if name in snapshot:
+                    lines.extend(metric.lines(snapshot[name], (("worker", worker),)))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+updates_total = registry.counter("bot_updates_total", "Принятые обновления по типу", "type")
+updates_in_flight = registry.gauge("bot_updates_in_flight", "Обновления в обработке")
+handler_seconds = registry.histogram("bot_handler_seconds", "Время обработчиков aiogram", "handler")
+handler_errors_total = registry.counter("bot_handler_errors_total", "Исключения в обработчиках", "handler")
+query_seconds = registry.histogram("bot_db_query_seconds", "Время запросов к базе по имени в каталоге", "query")
+db_acquire_seconds = registry.histogram("bot_db_acquire_seconds", "Ожидание соединения с базой", "backend")
+db_connections_opened_total = registry.counter("bot_db_connections_opened_total", "Открытые соединения с базой", "backend")
+db_connections_closed_total = registry.counter("bot_db_connections_closed_total", "Закрытые соединения с базой", "backend")
+loop_lag_seconds = registry.histogram("bot_event_loop_lag_seconds", "Опоздание цикла событий")
+
+
+class UpdateMetrics(BaseMiddleware):
+    # Внешний middleware на dp.update: считает все обновления, в том числе без обработчика
+    async def __call__(self, handler, event, data):
+        updates_total.inc(event.event_type)
+        updates_in_flight.inc()
+        try:
+            return await handler(event, data)
+        finally:
+            updates_in_flight.dec()
+
+
+class HandlerMetrics(BaseMiddleware):
+    # Внутренний middleware: вызывается уже для выбранного обработчика
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors_total.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(name, time.perf_counter() - started)
+
+
+def instrument(dp):
+    dp.update.outer_middleware(UpdateMetrics())
+    dp.message.middleware(HandlerMetrics())
+    dp.callback_query.middleware(HandlerMetrics())
+
+
+async def _watch_loop_lag(interval):
+    # Насколько позже заказанного просыпается sleep — столько ждали все остальные задачи
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe("", max(loop.time() - started - interval, 0.0))
+
+
+def start_loop_monitor(interval=METRICS_LOOP_LAG_INTERVAL):
+    return asyncio.create_task(_watch_loop_lag(interval))
+
+
+# Сэмплирующий профилировщик: отдельный поток раз в PROFILE_INTERVAL снимает стек
+# потока с циклом событий. Результат — «свёрнутые» стеки (формат flamegraph.pl / speedscope)
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def sample(self, thread_id, seconds):
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = _Tally()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if names:
+                    stacks[";".join(reversed(names))] += 1
+                time.sleep(self.interval)
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        finally:
+            self._lock.release()
+
+
+def setup_metrics(app, workers=None):
+    # workers — ShardRouter, если обновления разбирают дочерние процессы
+    if not METRICS_TOKEN:
+        print("ℹ️ METRICS_TOKEN не задан, /metrics и /debug/profile отключены")
+        return
+    profiler = SamplingProfiler()
+    expected = f"Bearer {METRICS_TOKEN}".encode()
+
+    def authorized(request):
+        header = request.headers.get("Authorization", "").encode("utf-8", "surrogateescape")
+        return hmac.compare_digest(header, expected)
+
+    async def handle_metrics(request):
+        if not authorized(request):
+            return web.Response(status=401)
+        snapshots = workers.worker_metrics() if workers is not None else ()
+        return web.Response(text=registry.render(snapshots), content_type="text/plain", charset="utf-8")
+
+    async def handle_profile(request):
+        # GET /debug/profile?seconds=10 — профиль этого процесса за указанное время
+        if not authorized(request):
+            return web.Response(status=401)
+        if not METRICS_PROFILER:
+            return web.Response(status=404)
+        try:
+            seconds = min(float(request.query.get("seconds", 10)), PROFILE_MAX_SECONDS)
+        except ValueError:
+            return web.Response(status=400)
+        loop = asyncio.get_running_loop()
+        folded = await loop.run_in_executor(None, profiler.sample, threading.get_ident(), seconds)
+        if folded is None:
+            return web.Response(status=409, text="Профилировщик уже запущен")
+        return web.Response(text=folded)
+
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/debug/profile", handle_profile)
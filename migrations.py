@@ -0,0 +1,360 @@
+# Версионные миграции схемы. Применяются один раз при запуске (init_db в main())
+# или вручную: python database.py migrate
+#
+# Каждая миграция — DDL для обоих бэкендов и, при необходимости, запросы из каталога
+# (queries.py), которые переносят уже накопленные данные. Миграции только добавляются
+# в конец списка, уже выпущенные не меняются.
+
+MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "базовые таблицы",
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                goal_amount DOUBLE PRECISION DEFAULT 0,
+                goal_end_date DATE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS transactions (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT,
+                type VARCHAR(10),
+                amount DOUBLE PRECISION,
+                category TEXT,
+                created_at TIMESTAMPTZ DEFAULT NOW()
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS todos (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT,
+                text TEXT,
+                is_done BOOLEAN DEFAULT FALSE,
+                due_date DATE
+            )
+            """,
+            # В старых базах todos создавалась без due_date
+            "ALTER TABLE todos ADD COLUMN IF NOT EXISTS due_date DATE",
+        ],
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                goal_amount REAL DEFAULT 0,
+                goal_end_date TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                type TEXT,
+                amount REAL,
+                category TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS todos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                text TEXT,
+                is_done BOOLEAN DEFAULT 0,
+                due_date TEXT
+            )
+            """,
+        ],
+    },
+    {
+        "version": 2,
+        "name": "нарастающие итоги пользователей",
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS user_totals (
+                user_id BIGINT PRIMARY KEY,
+                balance DOUBLE PRECISION NOT NULL DEFAULT 0,
+                total_income DOUBLE PRECISION NOT NULL DEFAULT 0,
+                total_expense DOUBLE PRECISION NOT NULL DEFAULT 0
+            )
+            """,
+        ],
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS user_totals (
+                user_id INTEGER PRIMARY KEY,
+                balance REAL NOT NULL DEFAULT 0,
+                total_income REAL NOT NULL DEFAULT 0,
+                total_expense REAL NOT NULL DEFAULT 0
+            )
+            """,
+        ],
+        "data": ["totals_reset_all", "totals_rebuild_all"],
+    },
+    {
+        "version": 3,
+        "name": "свёртки по периодам",
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS rollups (
+                user_id BIGINT NOT NULL,
+                period VARCHAR(5) NOT NULL,
+                bucket VARCHAR(10) NOT NULL,
+                income DOUBLE PRECISION NOT NULL DEFAULT 0,
+                expense DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, period, bucket)
+            )
+            """,
+        ],
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS rollups (
+                user_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                income REAL NOT NULL DEFAULT 0,
+                expense REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, period, bucket)
+            )
+            """,
+        ],
+        "data": [
+            "rollups_reset_all",
+            "rollup_rebuild_day_all",
+            "rollup_rebuild_week_all",
+            "rollup_rebuild_month_all",
+            "rollup_rebuild_year_all",
+        ],
+    },
+    {
+        "version": 4,
+        "name": "индексы для запросов по пользователю",
+        "postgres": [
+            "CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created ON transactions (user_id, type, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_todos_user ON todos (user_id, id)",
+        ],
+        "sqlite": [
+            "CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created ON transactions (user_id, type, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_todos_user ON todos (user_id, id)",
+        ],
+    },
+    {
+        "version": 5,
+        "name": "хранилище состояний FSM",
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                expires_at BIGINT NOT NULL
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at)",
+        ],
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                expires_at INTEGER NOT NULL
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at)",
+        ],
+    },
+    {
+        "version": 6,
+        "name": "напоминания о задачах и целях",
+        "postgres": [
+            "ALTER TABLE todos ADD COLUMN IF NOT EXISTS reminded_on DATE",
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS goal_reminded_on DATE",
+            # Частичные индексы: в них только то, о чём ещё предстоит напомнить
+            """
+            CREATE INDEX IF NOT EXISTS idx_todos_due_pending ON todos (due_date)
+            WHERE is_done = FALSE AND reminded_on IS NULL
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_users_goal_pending ON users (goal_end_date)
+            WHERE goal_amount > 0 AND goal_reminded_on IS NULL
+            """,
+        ],
+        "sqlite": [
+            "ALTER TABLE todos ADD COLUMN reminded_on TEXT",
+            "ALTER TABLE users ADD COLUMN goal_reminded_on TEXT",
+            """
+            CREATE INDEX IF NOT EXISTS idx_todos_due_pending ON todos (due_date)
+            WHERE is_done = FALSE AND reminded_on IS NULL
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_users_goal_pending ON users (goal_end_date)
+            WHERE goal_amount > 0 AND goal_reminded_on IS NULL
+            """,
+        ],
+    },
+    {
+        "version": 7,
+        "name": "помесячные секции операций и архив старых месяцев",
+        "postgres": [
+            # transactions становится секционированной по created_at (секция на месяц UTC).
+            # Строки без своей секции попадают в DEFAULT, пока для их месяца её не создадут
+            "ALTER TABLE transactions RENAME TO transactions_unpartitioned",
+            "ALTER TABLE transactions_unpartitioned RENAME CONSTRAINT transactions_pkey TO transactions_unpartitioned_pkey",
+            "DROP INDEX IF EXISTS idx_transactions_user_type_created",
+            """
+            CREATE TABLE transactions (
+                id BIGINT NOT NULL DEFAULT nextval('transactions_id_seq'),
+                user_id BIGINT,
+                type VARCHAR(10),
+                amount DOUBLE PRECISION,
+                category TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+            """,
+            "ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id",
+            "CREATE TABLE transactions_default PARTITION OF transactions DEFAULT",
+            "CREATE INDEX idx_transactions_user_type_created ON transactions (user_id, type, created_at)",
+            "CREATE INDEX idx_transactions_created ON transactions (created_at)",
+            # Секция месяца [start_at, end_at): строки этого месяца из DEFAULT переезжают в неё
+            """
+            CREATE OR REPLACE FUNCTION transactions_ensure_partition(start_at TIMESTAMPTZ, end_at TIMESTAMPTZ)
+            RETURNS VOID AS $$
+            DECLARE
+                part TEXT := 'transactions_' || to_char(start_at AT TIME ZONE 'UTC', 'YYYY_MM');
+            BEGIN
+                -- Несколько процессов не должны создавать одну секцию одновременно
+                PERFORM pg_advisory_xact_lock(7263002);
+                IF to_regclass(part) IS NOT NULL THEN
+                    RETURN;
+                END IF;
+                EXECUTE format('CREATE TABLE %I (LIKE transactions INCLUDING DEFAULTS)', part);
+                EXECUTE format(
+                    'WITH moved AS (DELETE FROM transactions_default WHERE created_at >= $1 AND created_at < $2 '
+                    'RETURNING *) INSERT INTO %I SELECT * FROM moved', part
+                ) USING start_at, end_at;
+                EXECUTE format(
+                    'ALTER TABLE transactions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                    part, start_at, end_at
+                );
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            # Месяц уже в архиве: секция удаляется целиком, без DELETE по строкам
+            """
+            CREATE OR REPLACE FUNCTION transactions_drop_month(start_at TIMESTAMPTZ, end_at TIMESTAMPTZ)
+            RETURNS VOID AS $$
+            BEGIN
+                DELETE FROM transactions_default WHERE created_at >= start_at AND created_at < end_at;
+                EXECUTE format('DROP TABLE IF EXISTS %I', 'transactions_' || to_char(start_at AT TIME ZONE 'UTC', 'YYYY_MM'));
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            DO $$
+            DECLARE
+                month TIMESTAMP;
+            BEGIN
+                FOR month IN
+                    SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC')
+                    FROM transactions_unpartitioned WHERE created_at IS NOT NULL
+                LOOP
+                    PERFORM transactions_ensure_partition(
+                        month AT TIME ZONE 'UTC', (month + INTERVAL '1 month') AT TIME ZONE 'UTC'
+                    );
+                END LOOP;
+            END
+            $$
+            """,
+            """
+            INSERT INTO transactions (id, user_id, type, amount, category, created_at)
+            SELECT id, user_id, type, amount, category, COALESCE(created_at, NOW()) FROM transactions_unpartitioned
+            """,
+            "DROP TABLE transactions_unpartitioned",
+            # Архив: одна строка на (пользователь, месяц), операции — массивом
+            # [id, created_at, type, amount, category]. Итоги по этим месяцам остаются в rollups
+            """
+            CREATE TABLE IF NOT EXISTS transactions_archive (
+                user_id BIGINT NOT NULL,
+                month VARCHAR(7) NOT NULL,
+                rows JSONB NOT NULL,
+                PRIMARY KEY (user_id, month)
+            )
+            """,
+            # Вся история — для пересчёта итогов и свёрток и для экспорта
+            """
+            CREATE VIEW transactions_history AS
+            SELECT id, user_id, type, amount, category, created_at FROM transactions
+            UNION ALL
+            SELECT (r ->> 0)::BIGINT, a.user_id, r ->> 2, (r ->> 3)::DOUBLE PRECISION, r ->> 4, (r ->> 1)::TIMESTAMPTZ
+            FROM transactions_archive a CROSS JOIN LATERAL jsonb_array_elements(a.rows) r
+            """,
+        ],
+        "sqlite": [
+            # Секций в SQLite нет: старые месяцы переносятся в архив удалением по диапазону created_at
+            "CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions (created_at)",
+            """
+            CREATE TABLE IF NOT EXISTS transactions_archive (
+                user_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                rows TEXT NOT NULL,
+                PRIMARY KEY (user_id, month)
+            )
+            """,
+            """
+            CREATE VIEW IF NOT EXISTS transactions_history AS
+            SELECT id, user_id, type, amount, category, created_at FROM transactions
+            UNION ALL
+            SELECT json_extract(r.value, '$[0]'), a.user_id, json_extract(r.value, '$[2]'),
+                   json_extract(r.value, '$[3]'), json_extract(r.value, '$[4]'), json_extract(r.value, '$[1]')
+            FROM transactions_archive a, json_each(a.rows) r
+            """,
+        ],
+    },
+    {
+        "version": 8,
+        "name": "индекс для постраничного экспорта",
+        "postgres": [
+            "CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_at, id)",
+        ],
+        "sqlite": [
+            "CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_at, id)",
+        ],
+    },
+]
+
+SCHEMA_VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+async def migrate(db, dialect):
+    await db.script(SCHEMA_VERSION_TABLE)
+    await db.commit()
+
+    # Вся цепочка идёт одной транзакцией под блокировкой: либо схема
+    # доходит до последней версии, либо остаётся как была
+    await db.execute("migration_lock")
+    current = (await db.fetchone("schema_version"))[0]
+    applied = []
+    for migration in MIGRATIONS:
+        if migration["version"] <= current:
+            continue
+        for ddl in migration[dialect]:
+            await db.script(ddl)
+        for name in migration.get("data", ()):
+            await db.execute(name)
+        await db.execute("schema_version_add", (migration["version"], migration["name"]))
+        applied.append(migration)
+    await db.commit()
+
+    for migration in applied:
+        print(f"✅ Миграция {migration['version']}: {migration['name']}")
+    return applied
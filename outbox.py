@@ -0,0 +1,173 @@
+import os
+import time
+import asyncio
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import EditMessageCaption, EditMessageReplyMarkup, EditMessageText
+
+SEND_RATE = float(os.getenv("SEND_RATE", 30))  # сообщений в секунду на бота
+SEND_BURST = int(os.getenv("SEND_BURST", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))  # сообщений в секунду в один чат
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", 3))
+SEND_CHATS_MAX = int(os.getenv("SEND_CHATS_MAX", 10000))
+
+_EDITS = (EditMessageText, EditMessageReplyMarkup, EditMessageCaption)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self):
+        self._refill(time.monotonic())
+        return not self.waiting and self.tokens >= self.burst
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        # Lock выдаёт токены строго в порядке очереди
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+                    if delay <= 0:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+
+def _chat(method):
+    chat_id = getattr(method, "chat_id", None)
+    if chat_id is None:
+        chat_id = getattr(method, "inline_message_id", None)
+    return chat_id
+
+
+def _edit_key(method):
+    if not isinstance(method, _EDITS):
+        return None
+    return type(method), method.chat_id, method.message_id, method.inline_message_id
+
+
+# Все исходящие запросы бота в чаты проходят через два ведра токенов: общее
+# (SEND_RATE в секунду) и своё у каждого чата (SEND_CHAT_RATE). Ответ 429 ставит
+# чат на паузу на retry_after и повторяет запрос до SEND_RETRIES раз. Если правку
+# сообщения обогнала более новая правка того же сообщения, старая не отправляется
+# и получает результат новой. Запросы без чата (answerCallbackQuery, getUpdates)
+# проходят без ограничений.
+class SendQueue(BaseRequestMiddleware):
+    def __init__(self, rate=SEND_RATE, burst=SEND_BURST, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, retries=SEND_RETRIES, max_chats=SEND_CHATS_MAX):
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.max_chats = max_chats
+        self._chats = {}
+        self._edits = {}
+        self.waiting = 0
+        self.max_waiting = 0
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                # Вёдра без очереди и полные можно создать заново без потерь
+                for key in [key for key, b in self._chats.items() if b.idle]:
+                    del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = _chat(method)
+        if chat_id is None:
+            return await make_request(bot, method)
+        key = _edit_key(method)
+        if key is None:
+            return await self._send(make_request, bot, method, chat_id)
+        mine = asyncio.get_running_loop().create_future()
+        self._edits[key] = mine
+        result = None
+        try:
+            result = await self._send(make_request, bot, method, chat_id, key, mine)
+            return result
+        finally:
+            if not mine.done():
+                mine.set_result(result)
+            if self._edits.get(key) is mine:
+                del self._edits[key]
+
+    async def _send(self, make_request, bot, method, chat_id, key=None, mine=None):
+        bucket = self._chat_bucket(chat_id)
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            for attempt in range(self.retries + 1):
+                await bucket.acquire()
+                if key is not None and self._edits.get(key) is not mine:
+                    # Сообщение уже правит более новый запрос — ждём его
+                    bucket.refund()
+                    self.coalesced += 1
+                    newer = self._edits.get(key)
+                    result = await asyncio.shield(newer) if newer is not None else None
+                    return True if result is None else result
+                await self.bucket.acquire()
+                try:
+                    result = await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    bucket.pause(e.retry_after)
+                    if attempt == self.retries:
+                        self.failed += 1
+                        raise
+                    self.retried += 1
+                    continue
+                except TelegramBadRequest as e:
+                    if key is not None and "message is not modified" in e.message:
+                        self.coalesced += 1
+                        return True
+                    self.failed += 1
+                    raise
+                except Exception:
+                    self.failed += 1
+                    raise
+                self.sent += 1
+                return result
+        finally:
+            self.waiting -= 1
+
+    def stats(self):
+        return {
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "waiting_chats": sum(1 for b in self._chats.values() if b.waiting),
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+        }
@@ -0,0 +1,305 @@
+# Общий каталог SQL-запросов для обоих бэкендов.
+# Плейсхолдеры везде пишутся как "?" — Postgres-бэкенд сам переводит их в $1, $2, ...
+# и готовит (PREPARE) каждый запрос один раз на соединение.
+
+_INCOME = "COALESCE(SUM(CASE WHEN type='income' THEN amount ELSE 0 END), 0)"
+_EXPENSE = "COALESCE(SUM(CASE WHEN type='expense' THEN amount ELSE 0 END), 0)"
+
+COMMON = {
+    "add_transaction":
+        "INSERT INTO transactions (user_id, type, amount, category, created_at) VALUES (?, ?, ?, ?, ?)",
+    "set_goal": """
+        INSERT INTO users (user_id, goal_amount, goal_end_date) VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE
+        SET goal_amount = excluded.goal_amount, goal_end_date = excluded.goal_end_date,
+            goal_reminded_on = NULL
+    """,
+    "clear_goal":
+        "UPDATE users SET goal_amount = 0, goal_end_date = NULL, goal_reminded_on = NULL WHERE user_id = ?",
+    # Удаление по месяцам пользователя (их список — в rollups): каждый DELETE
+    # затрагивает одну секцию в Postgres и один диапазон индекса в SQLite
+    "user_months":
+        "SELECT bucket FROM rollups WHERE user_id = ? AND period = 'month'",
+    "delete_transactions_range":
+        "DELETE FROM transactions WHERE user_id = ? AND created_at >= ? AND created_at < ?",
+    # Архивный месяц страницы экспорта и следующий за ним
+    "archive_months_from":
+        "SELECT month FROM transactions_archive WHERE user_id = ? AND month >= ? ORDER BY month LIMIT 2",
+    "delete_archive":
+        "DELETE FROM transactions_archive WHERE user_id = ?",
+    "transactions_oldest":
+        "SELECT MIN(created_at) FROM transactions",
+    "delete_todos":
+        "DELETE FROM todos WHERE user_id = ?",
+    "get_user_goal":
+        "SELECT goal_amount, goal_end_date FROM users WHERE user_id = ?",
+    "get_totals":
+        "SELECT balance, total_income, total_expense FROM user_totals WHERE user_id = ?",
+    # Баланс и итоги ведутся нарастающим итогом в той же транзакции, что и вставка
+    "totals_add": """
+        INSERT INTO user_totals (user_id, balance, total_income, total_expense) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE
+        SET balance = user_totals.balance + excluded.balance,
+            total_income = user_totals.total_income + excluded.total_income,
+            total_expense = user_totals.total_expense + excluded.total_expense
+    """,
+    "totals_reset":
+        "DELETE FROM user_totals WHERE user_id = ?",
+    "totals_reset_all":
+        "DELETE FROM user_totals",
+    # Пересчёты читают историю целиком (горячие операции и архив) — представление transactions_history
+    "totals_rebuild":
+        "INSERT INTO user_totals (user_id, balance, total_income, total_expense) "
+        "SELECT user_id, " + _INCOME + " - " + _EXPENSE + ", " + _INCOME + ", " + _EXPENSE + " "
+        "FROM transactions_history WHERE user_id = ? GROUP BY user_id",
+    # Пересчёт всех итогов. Вариант по transactions нужен миграции 2: архива тогда ещё нет
+    "totals_rebuild_all":
+        "INSERT INTO user_totals (user_id, balance, total_income, total_expense) "
+        "SELECT user_id, " + _INCOME + " - " + _EXPENSE + ", " + _INCOME + ", " + _EXPENSE + " "
+        "FROM transactions GROUP BY user_id",
+    "totals_rebuild_all_history":
+        "INSERT INTO user_totals (user_id, balance, total_income, total_expense) "
+        "SELECT user_id, " + _INCOME + " - " + _EXPENSE + ", " + _INCOME + ", " + _EXPENSE + " "
+        "FROM transactions_history GROUP BY user_id",
+    "totals_from_transactions":
+        "SELECT user_id, " + _INCOME + ", " + _EXPENSE + " FROM transactions_history GROUP BY user_id",
+    "totals_all":
+        "SELECT user_id, total_income, total_expense, balance FROM user_totals",
+    # Свёртки по периодам: одна строка на (пользователь, период, корзина)
+    "rollup_add": """
+        INSERT INTO rollups (user_id, period, bucket, income, expense) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, period, bucket) DO UPDATE
+        SET income = rollups.income + excluded.income,
+            expense = rollups.expense + excluded.expense
+    """,
+    "rollup_get":
+        "SELECT income, expense FROM rollups WHERE user_id = ? AND period = ? AND bucket = ?",
+    # Доходы/расходы за период и общий баланс — за один запрос
+    "stats_snapshot": """
+        SELECT COALESCE(r.income, 0), COALESCE(r.expense, 0), COALESCE(t.balance, 0)
+        FROM (SELECT CAST(? AS BIGINT) AS user_id) u
+        LEFT JOIN user_totals t ON t.user_id = u.user_id
+        LEFT JOIN rollups r ON r.user_id = u.user_id AND r.period = ? AND r.bucket = ?
+    """,
+    # То же сразу для дня, недели, месяца и года: по строке на найденный период
+    "stats_all_periods": """
+        SELECT COALESCE(t.balance, 0), r.period, r.income, r.expense
+        FROM (SELECT CAST(? AS BIGINT) AS user_id) u
+        LEFT JOIN user_totals t ON t.user_id = u.user_id
+        LEFT JOIN rollups r ON r.user_id = u.user_id AND (
+            (r.period = 'day' AND r.bucket = ?) OR
+            (r.period = 'week' AND r.bucket = ?) OR
+            (r.period = 'month' AND r.bucket = ?) OR
+            (r.period = 'year' AND r.bucket = ?)
+        )
+    """,
+    "rollups_reset":
+        "DELETE FROM rollups WHERE user_id = ?",
+    "rollups_reset_all":
+        "DELETE FROM rollups",
+    "rollups_all":
+        "SELECT user_id, period, bucket, income, expense FROM rollups",
+    # Состояния FSM aiogram: одна строка на ключ, протухшие строки не видны и удаляются пачками
+    "fsm_get":
+        "SELECT state, data FROM fsm_states WHERE key = ? AND expires_at > ?",
+    "fsm_set_state": """
+        INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, '{}', ?)
+        ON CONFLICT (key) DO UPDATE
+        SET state = excluded.state,
+            data = CASE WHEN fsm_states.expires_at > ? THEN fsm_states.data ELSE '{}' END,
+            expires_at = excluded.expires_at
+    """,
+    "fsm_set_data": """
+        INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, NULL, ?, ?)
+        ON CONFLICT (key) DO UPDATE
+        SET state = CASE WHEN fsm_states.expires_at > ? THEN fsm_states.state ELSE NULL END,
+            data = excluded.data,
+            expires_at = excluded.expires_at
+    """,
+    "fsm_clear_state":
+        "UPDATE fsm_states SET state = NULL WHERE key = ?",
+    "fsm_clear_data":
+        "UPDATE fsm_states SET data = '{}' WHERE key = ?",
+    "fsm_delete_empty":
+        "DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'",
+    "fsm_cleanup":
+        "DELETE FROM fsm_states WHERE key IN (SELECT key FROM fsm_states WHERE expires_at <= ? LIMIT ?)",
+    # Напоминания: пачка строк забирается одним UPDATE ... RETURNING, повторная проверка
+    # условия во внешнем WHERE не даёт двум процессам забрать одну и ту же строку
+    "todos_claim_due": """
+        UPDATE todos SET reminded_on = ?
+        WHERE id IN (
+            SELECT id FROM todos
+            WHERE due_date <= ? AND due_date >= ? AND is_done = FALSE AND reminded_on IS NULL
+            ORDER BY id LIMIT ?
+        ) AND reminded_on IS NULL
+        RETURNING id, user_id, text, due_date
+    """,
+    "todo_unclaim":
+        "UPDATE todos SET reminded_on = NULL WHERE id = ?",
+    "goals_claim_due": """
+        UPDATE users SET goal_reminded_on = ?
+        WHERE user_id IN (
+            SELECT user_id FROM users
+            WHERE goal_end_date BETWEEN ? AND ? AND goal_amount > 0 AND goal_reminded_on IS NULL
+            ORDER BY user_id LIMIT ?
+        ) AND goal_reminded_on IS NULL
+        RETURNING user_id, goal_amount, goal_end_date
+    """,
+    "goal_unclaim":
+        "UPDATE users SET goal_reminded_on = NULL WHERE user_id = ?",
+    "schema_version":
+        "SELECT COALESCE(MAX(version), 0) FROM schema_version",
+    "schema_version_add":
+        "INSERT INTO schema_version (version, name) VALUES (?, ?)",
+    "add_todo":
+        "INSERT INTO todos (user_id, text, due_date) VALUES (?, ?, ?)",
+    "get_todos":
+        "SELECT id, text, is_done, due_date FROM todos WHERE user_id = ?",
+    # Постраничный вывод по ключу (id), без OFFSET: каждая страница — поиск по индексу (user_id, id)
+    "todos_page_first":
+        "SELECT id, text, is_done, due_date FROM todos WHERE user_id = ? ORDER BY id LIMIT ?",
+    "todos_page_after":
+        "SELECT id, text, is_done, due_date FROM todos WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+    "todos_page_before":
+        "SELECT id, text, is_done, due_date FROM todos WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+    "get_todo":
+        "SELECT id, text, is_done, due_date FROM todos WHERE user_id = ? AND id = ?",
+    "delete_todo":
+        "DELETE FROM todos WHERE id = ? AND user_id = ?",
+    # Явное значение, а не NOT is_done: повтор того же запроса ничего не меняет
+    "complete_todo":
+        "UPDATE todos SET is_done = TRUE WHERE id = ? AND user_id = ?",
+}
+
+# Ключ корзины для created_at (UTC) в каждом периоде; неделя начинается с понедельника.
+# Должен совпадать с database.period_buckets()
+_BUCKETS = {
+    "postgres": {
+        "day": "TO_CHAR(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD')",
+        "week": "TO_CHAR(DATE_TRUNC('week', created_at AT TIME ZONE 'UTC'), 'YYYY-MM-DD')",
+        "month": "TO_CHAR(created_at AT TIME ZONE 'UTC', 'YYYY-MM')",
+        "year": "TO_CHAR(created_at AT TIME ZONE 'UTC', 'YYYY')",
+    },
+    "sqlite": {
+        "day": "strftime('%Y-%m-%d', created_at)",
+        "week": "date(created_at, 'weekday 0', '-6 days')",
+        "month": "strftime('%Y-%m', created_at)",
+        "year": "strftime('%Y', created_at)",
+    },
+}
+
+
+def _rollup_queries(dialect):
+    queries = {}
+    for period, bucket in _BUCKETS[dialect].items():
+        grouped = (
+            f"SELECT user_id, '{period}', {bucket}, {_INCOME}, {_EXPENSE} FROM {{source}} "
+            "{where}" f"GROUP BY user_id, {bucket}"
+        )
+        insert = "INSERT INTO rollups (user_id, period, bucket, income, expense) "
+        queries[f"rollup_rebuild_{period}"] = insert + grouped.format(
+            source="transactions_history", where="WHERE user_id = ? ")
+        # Вариант по transactions — для миграции 3, когда архива ещё нет
+        queries[f"rollup_rebuild_{period}_all"] = insert + grouped.format(source="transactions", where="")
+        queries[f"rollup_rebuild_{period}_all_history"] = insert + grouped.format(
+            source="transactions_history", where="")
+        queries[f"rollup_expected_{period}"] = grouped.format(source="transactions_history", where="")
+    return queries
+
+
+DIALECT = {dialect: _rollup_queries(dialect) for dialect in _BUCKETS}
+
+# Миграции не должны идти одновременно из нескольких процессов
+DIALECT["postgres"]["migration_lock"] = "SELECT pg_advisory_xact_lock(7263001)"
+DIALECT["sqlite"]["migration_lock"] = "BEGIN IMMEDIATE"
+
+# Массовая загрузка операций: COPY в Postgres, INSERT пачкой в SQLite
+DIALECT["postgres"]["transactions_copy"] = (
+    "COPY transactions (user_id, type, amount, category, created_at) FROM STDIN"
+)
+DIALECT["sqlite"]["transactions_copy"] = (
+    "INSERT INTO transactions (user_id, type, amount, category, created_at) VALUES (?, ?, ?, ?, ?)"
+)
+
+# Операции для аналитики: время сразу в секундах UTC, чтобы столбцы ложились в массивы NumPy
+DIALECT["postgres"]["analytics_transactions"] = (
+    "SELECT EXTRACT(EPOCH FROM created_at)::BIGINT, type = 'expense', amount, COALESCE(category, '') "
+    "FROM transactions WHERE user_id = ? AND created_at >= ?"
+)
+DIALECT["sqlite"]["analytics_transactions"] = (
+    "SELECT CAST(strftime('%s', created_at) AS INTEGER), type = 'expense', amount, COALESCE(category, '') "
+    "FROM transactions WHERE user_id = ? AND created_at >= ?"
+)
+
+# Архивация месяца [start, end): операции каждого пользователя сворачиваются в одну строку
+# transactions_archive, после чего месяц удаляется из transactions (в Postgres — секция целиком).
+# Операции, дописанные в уже архивный месяц (импорт старой истории), дописываются к его строке
+DIALECT["postgres"]["archive_month"] = """
+    INSERT INTO transactions_archive (user_id, month, rows)
+    SELECT user_id, CAST(? AS VARCHAR(7)),
+           jsonb_agg(jsonb_build_array(id, created_at, type, amount, category) ORDER BY created_at, id)
+    FROM transactions WHERE created_at >= ? AND created_at < ?
+    GROUP BY user_id
+    ON CONFLICT (user_id, month) DO UPDATE SET rows = transactions_archive.rows || excluded.rows
+"""
+DIALECT["sqlite"]["archive_month"] = """
+    INSERT INTO transactions_archive (user_id, month, rows)
+    SELECT user_id, ?, json_group_array(json_array(id, created_at, type, amount, category))
+    FROM (
+        SELECT * FROM transactions WHERE created_at >= ? AND created_at < ? ORDER BY created_at, id
+    ) WHERE true
+    GROUP BY user_id
+    ON CONFLICT (user_id, month) DO UPDATE SET rows = (
+        SELECT json_group_array(json(value)) FROM (
+            SELECT value FROM json_each(transactions_archive.rows)
+            UNION ALL SELECT value FROM json_each(excluded.rows)
+        )
+    )
+"""
+DIALECT["postgres"]["archive_drop_month"] = "SELECT transactions_drop_month(?, ?)"
+DIALECT["sqlite"]["archive_drop_month"] = "DELETE FROM transactions WHERE created_at >= ? AND created_at < ?"
+# Секции создаются заранее, чтобы новые операции не копились в DEFAULT
+DIALECT["postgres"]["ensure_partition"] = "SELECT transactions_ensure_partition(?, ?)"
+# Месяцы, чьи строки лежат в DEFAULT: задним числом записанные операции, импорт старой истории
+DIALECT["postgres"]["default_months"] = (
+    "SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' FROM transactions_default"
+)
+
+# Экспорт страницами по ключу (created_at, id), каждая страница — отдельная короткая сессия.
+# Не через transactions_history: представление сортируется целиком на каждой странице.
+# Страница берёт из архива ровно один месяц, а живые строки (по idx_transactions_user_created) —
+# только до начала следующего архивного месяца: так ни один архивный месяц не распаковывается
+# дважды за пределами своих страниц. Параметры архива — пользователь и месяц 'ГГГГ-ММ'
+_ARCHIVE_ROWS = {
+    "postgres":
+        "SELECT (r ->> 1)::TIMESTAMPTZ AS created_at, r ->> 2 AS type, "
+        "(r ->> 3)::DOUBLE PRECISION AS amount, r ->> 4 AS category, (r ->> 0)::BIGINT AS id "
+        "FROM transactions_archive a CROSS JOIN LATERAL jsonb_array_elements(a.rows) r "
+        "WHERE a.user_id = ? AND a.month = ?",
+    "sqlite":
+        "SELECT json_extract(r.value, '$[1]') AS created_at, json_extract(r.value, '$[2]') AS type, "
+        "json_extract(r.value, '$[3]') AS amount, json_extract(r.value, '$[4]') AS category, "
+        "json_extract(r.value, '$[0]') AS id "
+        "FROM transactions_archive a, json_each(a.rows) r "
+        "WHERE a.user_id = ? AND a.month = ?",
+}
+_EXPORT_PAGE = """
+    SELECT * FROM (
+        SELECT created_at, type, amount, category, id FROM transactions
+        WHERE user_id = ?{after} AND created_at < ? ORDER BY created_at, id LIMIT ?
+    ) live
+    UNION ALL
+    SELECT * FROM ({archive}) archived WHERE true{after}
+    ORDER BY created_at, id LIMIT ?
+"""
+for _dialect, _archive in _ARCHIVE_ROWS.items():
+    DIALECT[_dialect]["export_transactions_first"] = _EXPORT_PAGE.format(after="", archive=_archive)
+    DIALECT[_dialect]["export_transactions_after"] = _EXPORT_PAGE.format(
+        after=" AND (created_at, id) > (?, ?)", archive=_archive)
+
+
+def catalogue(dialect):
+    queries = dict(COMMON)
+    queries.update(DIALECT[dialect])
+    return queries
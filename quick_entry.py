@@ -0,0 +1,192 @@
+import re
+from collections import Counter
+from datetime import datetime, timezone
+
+# Операция одной строкой: «-350 кофе», «+50000 зарплата 12.10», «1 200,50 такси 03.09.2025».
+# Знак задаёт тип. Без знака строка — операция, только если пометка точно совпадает с известной
+# категорией (тип по ней: зарплата — доход, остальное — расход): одно число вроде «100»,
+# «12.10» или «10000 15.12.2026» может быть чем угодно и записью не считается
+_ENTRY = re.compile(
+    r"""^\s*(?P<sign>[+-])?\s*
+    (?P<amount>\d{1,3}(?:[ \u00a0]\d{3})+(?:[.,]\d{1,2})?|\d+(?:[.,]\d{1,2})?)
+    \s*(?:₽|руб\.?|р\.?)?
+    (?:\s+(?P<text>.*?))??
+    (?:\s+(?P<day>\d{1,2})\.(?P<month>\d{1,2})(?:\.(?P<year>\d{2}|\d{4}))?)?
+    \s*$""",
+    re.VERBOSE | re.IGNORECASE,
+)
+_WORD = re.compile(r"[a-zа-яё]+")
+_SPACES = re.compile(r"[ \u00a0]")
+
+# Категория -> её написания; по ним строится точный словарь и индекс триграмм
+CATEGORIES = {
+    "еда": ("еда", "продукты", "магазин", "супермаркет", "пятерочка", "перекресток", "магнит", "ашан", "лента"),
+    "кафе": ("кафе", "кофе", "ресторан", "обед", "ужин", "завтрак", "бар", "пицца", "шаурма", "доставка"),
+    "транспорт": ("транспорт", "такси", "метро", "автобус", "трамвай", "электричка", "бензин", "заправка", "парковка", "каршеринг"),
+    "жильё": ("жильё", "жилье", "аренда", "квартплата", "коммуналка", "жкх", "ипотека", "электричество"),
+    "связь": ("связь", "телефон", "интернет", "мобильный", "мобильная"),
+    "здоровье": ("здоровье", "аптека", "лекарства", "врач", "стоматолог", "анализы"),
+    "одежда": ("одежда", "обувь", "куртка", "джинсы"),
+    "развлечения": ("развлечения", "кино", "театр", "концерт", "игры", "подписка"),
+    "подарки": ("подарки", "подарок", "цветы"),
+    "образование": ("образование", "курсы", "книги", "учеба", "учёба"),
+    "спорт": ("спорт", "фитнес", "спортзал", "бассейн"),
+    "зарплата": ("зарплата", "зп", "аванс", "премия", "оклад"),
+    "подработка": ("подработка", "фриланс", "заказ", "халтура"),
+    "кэшбэк": ("кэшбэк", "кешбек", "кешбэк", "cashback"),
+    "проценты": ("проценты", "вклад", "дивиденды", "купоны"),
+}
+INCOME_CATEGORIES = {"зарплата", "подработка", "кэшбэк", "проценты"}
+FUZZY_THRESHOLD = 0.4
+_CATEGORY_MAX = 50
+
+
+def _trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Индекс для нечёткого поиска: триграмма -> написания, в которых она есть.
+# Кандидаты набираются только по общим триграммам, а не перебором всего словаря
+class AliasIndex:
+    def __init__(self, categories):
+        self.exact = {}
+        self._aliases = []
+        self._sizes = []
+        self._postings = {}
+        for category, aliases in categories.items():
+            for alias in aliases:
+                alias = alias.lower().replace("ё", "е")
+                self.exact[alias] = category
+                grams = _trigrams(alias)
+                index = len(self._aliases)
+                self._aliases.append(category)
+                self._sizes.append(len(grams))
+                for gram in grams:
+                    self._postings.setdefault(gram, []).append(index)
+
+    def fuzzy(self, word, threshold=FUZZY_THRESHOLD):
+        # Лучшее совпадение по коэффициенту Жаккара на триграммах или None
+        grams = _trigrams(word)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        best, best_score = None, threshold
+        for index, common in shared.items():
+            score = common / (len(grams) + self._sizes[index] - common)
+            if score >= best_score:
+                best, best_score = self._aliases[index], score
+        return best
+
+    def lookup(self, text, fuzzy=True):
+        # Категория по свободному тексту: сначала вся фраза, потом отдельные слова, потом нечётко
+        key = text.lower().replace("ё", "е")
+        category = self.exact.get(key)
+        if category:
+            return category
+        words = _WORD.findall(key)
+        for word in words:
+            category = self.exact.get(word)
+            if category:
+                return category
+        if not fuzzy:
+            return None
+        for word in words:
+            if len(word) >= 3:
+                category = self.fuzzy(word)
+                if category:
+                    return category
+        return None
+
+
+aliases = AliasIndex(CATEGORIES)
+
+
+def _entry_date(day, month, year, today):
+    # Полдень UTC, чтобы операция точно попала в свой день в свёртках. Операций из будущего
+    # не бывает, а такая выпала бы из всех итогов за период: «31.12» в январе — прошлый год,
+    # «01.01.99» — 1999-й, а будущая дата с годом — не операция (ValueError)
+    if not year:
+        moment = datetime(today.year, int(month), int(day), 12, tzinfo=timezone.utc)
+        if moment.date() > today:
+            moment = moment.replace(year=today.year - 1)
+        return moment
+    full_year = int(year)
+    if len(year) == 2:
+        full_year += today.year // 100 * 100
+        if full_year > today.year:
+            full_year -= 100
+    moment = datetime(full_year, int(month), int(day), 12, tzinfo=timezone.utc)
+    if moment.date() > today:
+        raise ValueError(f"дата в будущем: {moment.date()}")
+    return moment
+
+
+def parse_entry(text, today=None):
+    # (type, amount, category, created_at или None — «сейчас») либо None, если это не операция
+    match = _ENTRY.match(text)
+    if match is None:
+        return None
+    amount = float(_SPACES.sub("", match["amount"]).replace(",", "."))
+    if amount <= 0:
+        return None
+    note = (match["text"] or "").strip()
+    if match["sign"]:
+        category = aliases.lookup(note) if note else None
+        t_type = "income" if match["sign"] == "+" else "expense"
+    else:
+        category = aliases.lookup(note, fuzzy=False) if note else None
+        if category is None:
+            return None
+        t_type = "income" if category in INCOME_CATEGORIES else "expense"
+    if category is None:
+        # Незнакомое слово сохраняем как есть — это своя категория пользователя
+        category = note.lower()[:_CATEGORY_MAX] or ("доход" if t_type == "income" else "прочее")
+    created_at = None
+    if match["day"]:
+        try:
+            created_at = _entry_date(match["day"], match["month"], match["year"],
+                                     today or datetime.now(timezone.utc).date())
+        except ValueError:
+            return None
+    return t_type, amount, category, created_at
+
+
+def _bench(args):
+    import random
+    import time
+
+    notes = [alias for names in CATEGORIES.values() for alias in names]
+    typos = ["кофэ", "таксии", "продукьы", "зарплта", "аптеку", "бензинн", "интернетт", "ресторн", "метор"]
+    free = ["на день рождения Маше", "ремонт велосипеда", "штраф", "корм коту", ""]
+    dates = ["", "", "", " 12.10", " 3.9", " 01.02.2025", " 15.06.24"]
+    corpus = []
+    for _ in range(args.corpus):
+        amount = random.choice([f"{random.randint(1, 5000)}", f"{random.randint(1, 99)} {random.randint(0, 999):03d}",
+                                f"{random.randint(1, 999)},{random.randint(0, 99):02d}"])
+        note = random.choice(notes + typos + free + ["Кофе с собой", "такси домой"])
+        corpus.append(f"{random.choice(['', '-', '+', '- '])}{amount} {note}{random.choice(dates)}".strip())
+    corpus += ["привет", "📈 Статистика", "купить хлеба", "-кофе",
+               "100", "12.10", "10000 15.12.2026", "42 ремонт велосипеда"]  # не операции
+
+    parsed = sum(parse_entry(line) is not None for line in corpus)
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        for line in corpus:
+            parse_entry(line)
+    elapsed = time.perf_counter() - started
+    total = len(corpus) * args.rounds
+    print(f"Корпус: {len(corpus)} строк, распознано {parsed}")
+    print(f"⚡ {total / elapsed:,.0f} строк/с, {elapsed / total * 1e6:.1f} мкс на строку")
+    for line in corpus[:args.show]:
+        print(f"  {line!r} -> {parse_entry(line)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Замер скорости разбора быстрых записей")
+    parser.add_argument("--corpus", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--show", type=int, default=15)
+    _bench(parser.parse_args())
@@ -0,0 +1,159 @@
+import os
+import asyncio
+import functools
+from datetime import date, datetime, timedelta
+from aiogram.exceptions import TelegramForbiddenError
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from database import (
+    claim_due_todos, unclaim_todos, claim_due_goals, unclaim_goals, get_balance,
+    ensure_partitions, archive_old_months
+)
+
+REMINDER_HOUR = int(os.getenv("REMINDER_HOUR", 9))
+REMINDER_INTERVAL_MINUTES = int(os.getenv("REMINDER_INTERVAL_MINUTES", 15))
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", 100))
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", 20))  # сообщений в секунду, лимит Telegram ~30
+GOAL_REMIND_DAYS = int(os.getenv("GOAL_REMIND_DAYS", 3))
+TODO_LOOKBACK_DAYS = int(os.getenv("TODO_LOOKBACK_DAYS", 3))  # сколько дней догонять пропущенные сроки
+ARCHIVE_HOUR = int(os.getenv("ARCHIVE_HOUR", 4))  # ночью, когда записей меньше всего
+
+
+async def _send(bot, chat_id, text):
+    # True — доставлено или доставлять бессмысленно (бот заблокирован),
+    # False — стоит попробовать в следующий запуск. Ответы 429 уже
+    # повторяет очередь отправки (outbox.py)
+    try:
+        await bot.send_message(chat_id, text)
+        return True
+    except TelegramForbiddenError:
+        return True
+    except Exception as e:
+        print(f"❌ Не удалось отправить напоминание {chat_id}: {e}")
+        return False
+
+
+async def _send_batch(bot, messages, pending):
+    # messages: [(ключ строки, chat_id, текст)]; pending — ключи помеченных, но ещё
+    # не отправленных строк: доставленные из него убираются, неудачи остаются.
+    # Отправка, прерванная отменой, считается неотправленной: лучше повтор, чем потеря
+    for key, chat_id, text in messages:
+        if await _send(bot, chat_id, text):
+            pending.discard(key)
+        await asyncio.sleep(1 / REMINDER_RATE)
+
+
+def _todo_reminder(text, due_date, today):
+    # SQLite возвращает дату строкой, Postgres — объектом date
+    if str(due_date) == today.isoformat():
+        return f"⏰ Сегодня срок задачи: {text}"
+    return f"⏰ Срок задачи прошёл ({due_date}): {text}"
+
+
+async def send_todo_reminders(bot, today):
+    since = today - timedelta(days=TODO_LOOKBACK_DAYS)
+    sent = 0
+    while True:
+        rows = await claim_due_todos(today, since, REMINDER_BATCH)
+        if not rows:
+            return sent
+        pending = {todo_id for todo_id, *_ in rows}
+        try:
+            await _send_batch(bot, [
+                (todo_id, user_id, _todo_reminder(text, due_date, today))
+                for todo_id, user_id, text, due_date in rows
+            ], pending)
+        finally:
+            # Неудачи и остаток пачки, если задачу отменили посреди рассылки, — обратно в очередь
+            await asyncio.shield(unclaim_todos(sorted(pending)))
+        sent += len(rows) - len(pending)
+        if pending:
+            # Что-то не уходит — остальное оставим до следующего запуска
+            return sent
+
+
+async def send_goal_reminders(bot, today):
+    sent = 0
+    until = today + timedelta(days=GOAL_REMIND_DAYS)
+    while True:
+        rows = await claim_due_goals(today, until, REMINDER_BATCH)
+        if not rows:
+            return sent
+        pending = {user_id for user_id, *_ in rows}
+        try:
+            messages = []
+            for user_id, goal_amount, goal_end_date in rows:
+                end_date = date.fromisoformat(goal_end_date) if isinstance(goal_end_date, str) else goal_end_date
+                balance = await get_balance(user_id)
+                messages.append((user_id, user_id,
+                    f"🎯 До срока цели {goal_amount:.0f} ₽ осталось дней: {(end_date - today).days}\n"
+                    f"💰 Баланс: {balance:.0f} ₽"))
+            await _send_batch(bot, messages, pending)
+        finally:
+            await asyncio.shield(unclaim_goals(sorted(pending)))
+        sent += len(rows) - len(pending)
+        if pending:
+            return sent
+
+
+async def send_reminders(bot):
+    # Задача запускается часто, но рассылает только с REMINDER_HOUR: так напоминания
+    # не теряются, если бот был выключен в момент запуска
+    now = datetime.now()
+    if now.hour < REMINDER_HOUR:
+        return
+    today = now.date()
+    todos = await send_todo_reminders(bot, today)
+    goals = await send_goal_reminders(bot, today)
+    if todos or goals:
+        print(f"⏰ Напоминания: задачи {todos}, цели {goals}")
+
+
+async def maintain_history():
+    # Секции на следующие месяцы и перенос старых месяцев в архив
+    await ensure_partitions()
+    months = await archive_old_months()
+    if months:
+        print(f"🗄 В архив перенесены месяцы: {', '.join(months)}")
+
+
+# Задачи планировщика, которые выполняются прямо сейчас. AsyncIOScheduler.shutdown() их
+# только отменяет и не ждёт, а отменённой рассылке ещё нужна база, чтобы вернуть
+# неотправленное в очередь
+_running = set()
+
+
+def _tracked(job):
+    @functools.wraps(job)
+    async def run(*args):
+        task = asyncio.current_task()
+        _running.add(task)
+        try:
+            return await job(*args)
+        except asyncio.CancelledError:
+            # Отмена бывает только при остановке бота — это не ошибка задачи
+            return None
+        finally:
+            _running.discard(task)
+    return run
+
+
+async def stop_scheduler(scheduler):
+    # Вызывается до close_db: новых запусков нет, идущие отменены и дождались своих finally
+    running = list(_running)
+    scheduler.shutdown(wait=True)
+    await asyncio.gather(*running, return_exceptions=True)
+
+
+def setup_scheduler(bot):
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(
+        _tracked(send_reminders), "interval", args=(bot,),
+        minutes=REMINDER_INTERVAL_MINUTES, next_run_time=datetime.now(),
+        id="reminders", max_instances=1, coalesce=True
+    )
+    scheduler.add_job(
+        _tracked(maintain_history), "cron", hour=ARCHIVE_HOUR,
+        id="history", max_instances=1, coalesce=True
+    )
+    return scheduler
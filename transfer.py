@@ -0,0 +1,210 @@
+import os
+import csv
+import json
+import math
+import time
+import asyncio
+from datetime import datetime, timezone
+from itertools import islice
+
+from database import import_transactions, finish_import, export_transactions
+
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", 10000))
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", 5000))
+IMPORT_ERRORS_SHOWN = 5
+
+# Заголовки столбцов, которые понимает импорт (как в экспорте и как в русских таблицах)
+_COLUMNS = {
+    "date": "date", "created_at": "date", "дата": "date",
+    "type": "type", "тип": "type",
+    "amount": "amount", "сумма": "amount",
+    "category": "category", "категория": "category",
+}
+_TYPES = {"income": "income", "доход": "income", "expense": "expense", "расход": "expense"}
+_CATEGORIES = {"income": "доход", "expense": "прочее"}
+_DATE_FORMATS = ("%d.%m.%Y %H:%M", "%d.%m.%Y", "%d.%m.%Y %H:%M:%S")
+_EXPORT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _parse_date(value):
+    # Время без пояса считается UTC — так же его и выгружает экспорт
+    value = value.strip()
+    if not value:
+        return datetime.now(timezone.utc)
+    try:
+        # ISO (в том числе формат экспорта) разбирается на порядок быстрее strptime
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        for fmt in _DATE_FORMATS:
+            try:
+                return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+            except ValueError:
+                pass
+        raise
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def parse_record(record):
+    # record: {столбец: строка} -> (type, amount, category, created_at); ValueError, если строка негодна
+    amount = float(str(record.get("amount", "")).replace("\xa0", "").replace(" ", "").replace(",", "."))
+    if not math.isfinite(amount) or amount == 0:
+        raise ValueError("сумма")
+    t_type = str(record.get("type") or "").strip().lower()
+    if t_type:
+        t_type = _TYPES[t_type]
+    else:
+        # Без столбца «тип» знак суммы отличает расход от дохода
+        t_type = "expense" if amount < 0 else "income"
+    category = str(record.get("category") or "").strip() or _CATEGORIES[t_type]
+    return t_type, abs(amount), category, _parse_date(str(record.get("date") or ""))
+
+
+def _csv_records(lines):
+    # Выдаёт (номер строки в файле, запись или None для негодной строки)
+    header = next(lines, "")
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    columns = [_COLUMNS.get(name.strip().lower(), name) for name in next(csv.reader([header], dialect), [])]
+    reader = csv.reader(lines, dialect)
+    while True:
+        try:
+            values = next(reader)
+        except StopIteration:
+            return
+        except csv.Error:
+            yield reader.line_num + 1, None
+            continue
+        if values:
+            yield reader.line_num + 1, dict(zip(columns, values))
+
+
+def _jsonl_records(lines):
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict):
+            yield line_no, None
+            continue
+        yield line_no, {_COLUMNS.get(key.lower(), key): value for key, value in record.items()}
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []  # номера первых IMPORT_ERRORS_SHOWN негодных строк
+
+    def rows(self, user_id, records):
+        for line_no, record in records:
+            try:
+                if record is None:
+                    raise ValueError("строка")
+                yield (user_id, *parse_record(record))
+            except (ValueError, KeyError, TypeError):
+                self.skipped += 1
+                if len(self.errors) < IMPORT_ERRORS_SHOWN:
+                    self.errors.append(line_no)
+
+
+async def import_file(user_id, path, batch=IMPORT_BATCH):
+    # Файл читается потоково: в памяти только текущая пачка. Разбор идёт в отдельном
+    # потоке, чтобы большой файл не останавливал цикл событий
+    report = ImportReport()
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        lines = iter(f)
+        if path.lower().endswith((".jsonl", ".json", ".ndjson")):
+            records = _jsonl_records(lines)
+        else:
+            records = _csv_records(lines)
+        rows = report.rows(user_id, records)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(lambda: list(islice(rows, batch)))
+                if not chunk:
+                    break
+                await import_transactions(chunk)
+                report.imported += len(chunk)
+        finally:
+            if report.imported:
+                await finish_import(user_id)
+    return report
+
+
+async def export_file(user_id, path, batch=EXPORT_BATCH):
+    # Тот же формат, что принимает импорт; строки идут с сервера пачками по batch
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(("date", "type", "amount", "category"))
+        async for rows in export_transactions(user_id, batch):
+            out.writerows(
+                (created_at if isinstance(created_at, str)
+                 else created_at.astimezone(timezone.utc).strftime(_EXPORT_FORMAT),
+                 t_type, amount, category)
+                for created_at, t_type, amount, category in rows
+            )
+            count += len(rows)
+    return count
+
+
+async def _bench(args):
+    # Замер на синтетическом файле: генерация, импорт (с пересчётом итогов), экспорт
+    import random
+    import tempfile
+    from database import open_db, close_db, init_db, clear_all, archive_old_months
+
+    await open_db()
+    try:
+        await init_db()
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "import.csv")
+            started = time.perf_counter()
+            with open(source, "w", encoding="utf-8", newline="") as f:
+                out = csv.writer(f)
+                out.writerow(("date", "type", "amount", "category"))
+                for i in range(args.rows):
+                    out.writerow((f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} 12:00:00",
+                                  random.choice(("income", "expense")),
+                                  round(random.uniform(1, 5000), 2), f"категория {i % 20}"))
+            print(f"Файл: {args.rows} строк, {os.path.getsize(source) / 2**20:.1f} МБ "
+                  f"за {time.perf_counter() - started:.1f} с")
+
+            started = time.perf_counter()
+            report = await import_file(args.user, source)
+            elapsed = time.perf_counter() - started
+            print(f"📥 Импорт: {report.imported} строк за {elapsed:.1f} с ({report.imported / elapsed:,.0f} строк/с)")
+
+            started = time.perf_counter()
+            count = await export_file(args.user, os.path.join(tmp, "export.csv"))
+            elapsed = time.perf_counter() - started
+            print(f"📤 Экспорт: {count} строк за {elapsed:.1f} с ({count / elapsed:,.0f} строк/с)")
+
+            if args.archived:
+                # Файл целиком в 2024 году — после архивации вся история читается из transactions_archive
+                started = time.perf_counter()
+                months = await archive_old_months()
+                print(f"🗄 Архивация: {len(months)} мес. за {time.perf_counter() - started:.1f} с")
+                started = time.perf_counter()
+                count = await export_file(args.user, os.path.join(tmp, "export_archived.csv"))
+                elapsed = time.perf_counter() - started
+                print(f"📤 Экспорт из архива: {count} строк за {elapsed:.1f} с ({count / elapsed:,.0f} строк/с)")
+        await clear_all(args.user)
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Замер скорости импорта и экспорта операций")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--user", type=int, default=-1, help="служебный пользователь, данные удаляются после замера")
+    parser.add_argument("--archived", action="store_true",
+                        help="после первого экспорта перенести старые месяцы в архив (всех пользователей) и выгрузить снова")
+    asyncio.run(_bench(parser.parse_args()))
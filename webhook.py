@@ -0,0 +1,111 @@
+import os
+import hmac
+import asyncio
+import hashlib
+from aiogram.types import Update
+from aiohttp import web
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес сервиса, например https://bot.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 32))
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", 1000))
+
+
+def webhook_secret(bot_token):
+    # Секрет должен совпадать у всех экземпляров за балансировщиком, поэтому
+    # по умолчанию он выводится из токена, а не генерируется при запуске
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
+
+# Ограниченная очередь входящих обновлений (сырые dict из JSON): HTTP-ответ
+# Telegram уходит сразу, а обработку ведут WEBHOOK_WORKERS фоновых задач. Если очередь переполнена,
+# отвечаем 503 — Telegram повторит доставку позже.
+class UpdateQueue:
+    def __init__(self, dp, bot, workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_QUEUE_MAX):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._tasks = []
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
+
+    def submit(self, data):
+        try:
+            self._queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def _work(self):
+        while True:
+            data = await self._queue.get()
+            try:
+                update = Update.model_validate(data, context={"bot": self.bot})
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Ошибка обработки обновления {data.get('update_id')}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def stop(self):
+        # Дорабатываем то, что уже принято, и останавливаем обработчики
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+def setup_webhook(app, updates, bot_token):
+    # updates — любой приёмник с submit(dict) -> bool: UpdateQueue или ShardRouter
+    secret = webhook_secret(bot_token)
+
+    async def handle(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, secret):
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        if not updates.submit(data):
+            return web.Response(status=503)
+        return web.Response()
+
+    app.router.add_post(WEBHOOK_PATH, handle)
+    return updates
+
+
+async def register_webhook(dp, bot, bot_token):
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=webhook_secret(bot_token),
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(100, WEBHOOK_WORKERS * 2)
+    )
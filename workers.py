@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import queue
+import signal
+import asyncio
+import multiprocessing
+
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 1))
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", 1000))
+WORKER_STATS_INTERVAL = float(os.getenv("WORKER_STATS_INTERVAL", 5))
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", 30))
+
+
+def update_user_id(data):
+    # У всех пользовательских событий отправитель лежит в "from" (или "user")
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+    return None
+
+
+def shard_for(data, shards):
+    # Все обновления одного пользователя попадают в один процесс,
+    # поэтому его диалог FSM и записи идут строго по порядку
+    user_id = update_user_id(data)
+    key = user_id if user_id is not None else data.get("update_id", 0)
+    return hash(key) % shards
+
+
+# Главный процесс: принимает обновления (вебхук или polling) и раздаёт их
+# BOT_WORKERS дочерним процессам по хэшу from_user.id через multiprocessing-очереди.
+# Процессы раз в WORKER_STATS_INTERVAL секунд присылают свои счётчики.
+class ShardRouter:
+    def __init__(self, workers=BOT_WORKERS, max_pending=WORKER_QUEUE_MAX):
+        self.workers = workers
+        self._ctx = multiprocessing.get_context("spawn")
+        self._inboxes = [self._ctx.Queue(max_pending) for _ in range(workers)]
+        self._stats_queue = self._ctx.Queue()
+        self._procs = [None] * workers
+        self._watch_task = None
+        self.routed = [0] * workers
+        self.rejected = 0
+        self.restarts = 0
+        self.worker_stats = {}
+
+    def _spawn(self, index):
+        proc = self._ctx.Process(
+            target=worker_main,
+            args=(index, self._inboxes[index], self._stats_queue),
+            name=f"bot-worker-{index}"
+        )
+        proc.start()
+        self._procs[index] = proc
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        self._watch_task = asyncio.create_task(self._watch())
+
+    def submit(self, data):
+        index = shard_for(data, self.workers)
+        try:
+            self._inboxes[index].put_nowait(json.dumps(data))
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.routed[index] += 1
+        return True
+
+    def _collect_stats(self):
+        while True:
+            try:
+                stats = self._stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.worker_stats[stats["worker"]] = stats
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WORKER_STATS_INTERVAL)
+            self._collect_stats()
+            for index, proc in enumerate(self._procs):
+                if not proc.is_alive():
+                    # Очередь процесса сохраняется, новый процесс продолжит с неё
+                    print(f"❌ Процесс {proc.name} завершился с кодом {proc.exitcode}, перезапускаем")
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def stats(self):
+        self._collect_stats()
+        totals = {"processed": 0, "failed": 0, "in_flight": 0, "busy_seconds": 0.0}
+        for stats in self.worker_stats.values():
+            for name in totals:
+                totals[name] += stats.get(name, 0)
+        return {
+            "workers": self.workers,
+            "routed": sum(self.routed),
+            "routed_per_worker": list(self.routed),
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "queued": [inbox.qsize() for inbox in self._inboxes],
+            **totals,
+            "per_worker": [
+                {name: value for name, value in self.worker_stats.get(i, {}).items() if name != "metrics"}
+                for i in range(self.workers)
+            ],
+        }
+
+    def worker_metrics(self):
+        # Снимки метрик, которые процессы присылают вместе со счётчиками
+        self._collect_stats()
+        return [(index, stats["metrics"]) for index, stats in sorted(self.worker_stats.items())
+                if "metrics" in stats]
+
+    async def stop(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        # Блокирующий put на цикле событий повесил бы остановку, если очередь полна,
+        # а процесс завис или умер. Кто не вышел за WORKER_STOP_TIMEOUT, завершается
+        # принудительно: SIGTERM процессы игнорируют (worker_main), поэтому сразу SIGKILL
+        for inbox, proc in zip(self._inboxes, self._procs):
+            try:
+                inbox.put_nowait(None)
+            except queue.Full:
+                print(f"❌ Очередь {proc.name} переполнена, процесс не дождётся сигнала остановки")
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for proc in self._procs:
+            await loop.run_in_executor(None, proc.join, max(deadline - time.monotonic(), 0))
+            if proc.is_alive():
+                print(f"❌ Процесс {proc.name} не остановился за {WORKER_STOP_TIMEOUT:.0f} с, завершаем")
+                proc.kill()
+                await loop.run_in_executor(None, proc.join)
+        # Недочитанное остановленными процессами выбрасываем, иначе поток-писатель очереди
+        # не даст завершиться главному процессу
+        for inbox in self._inboxes:
+            inbox.cancel_join_thread()
+
+
+async def poll_updates(bot, dp, router):
+    # Long polling для режима с несколькими процессами: сами забираем
+    # обновления и раздаём их; при переполнении очередей ждём, а не теряем
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            print(f"❌ Ошибка получения обновлений: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            data = update.model_dump(mode="json", exclude_none=True)
+            while not router.submit(data):
+                await asyncio.sleep(0.1)
+            offset = update.update_id + 1
+
+
+def worker_main(index, inbox, stats_queue):
+    # Останавливает процессы главный, присылая None в очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.environ["BOT_WORKER_INDEX"] = str(index)
+    asyncio.run(_worker(index, inbox, stats_queue))
+
+
+async def _worker(index, inbox, stats_queue):
+    from aiogram.types import Update
+    from bot import bot, dp, storage, outbox
+    from charts import start_charts, close_charts
+    from database import open_db, close_db
+    from metrics import registry, start_loop_monitor
+
+    await open_db()
+    await start_charts()
+    loop = asyncio.get_running_loop()
+    locks = {}
+    waiting = {}
+    tasks = set()
+    stats = {"worker": index, "pid": os.getpid(), "processed": 0, "failed": 0, "busy_seconds": 0.0}
+
+    async def handle(data):
+        # Внутри процесса разные пользователи обрабатываются параллельно,
+        # а обновления одного пользователя — строго друг за другом
+        user_id = update_user_id(data)
+        lock = locks.setdefault(user_id, asyncio.Lock())
+        waiting[user_id] = waiting.get(user_id, 0) + 1
+        try:
+            async with lock:
+                started = time.perf_counter()
+                try:
+                    update = Update.model_validate(data, context={"bot": bot})
+                    await dp.feed_update(bot, update)
+                    stats["processed"] += 1
+                except Exception as e:
+                    stats["failed"] += 1
+                    print(f"❌ [worker {index}] Ошибка обработки обновления {data.get('update_id')}: {e}")
+                finally:
+                    stats["busy_seconds"] += time.perf_counter() - started
+        finally:
+            waiting[user_id] -= 1
+            if not waiting[user_id]:
+                del waiting[user_id]
+                del locks[user_id]
+
+    async def report():
+        while True:
+            await asyncio.sleep(WORKER_STATS_INTERVAL)
+            stats_queue.put({**stats, "in_flight": len(tasks), "outbox": outbox.stats(),
+                             "metrics": registry.snapshot(), "reported_at": time.time()})
+
+    reporter = asyncio.create_task(report())
+    lag_monitor = start_loop_monitor()
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, inbox.get)
+            if raw is None:
+                break
+            task = asyncio.create_task(handle(json.loads(raw)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        reporter.cancel()
+        lag_monitor.cancel()
+        stats_queue.put({**stats, "in_flight": 0, "reported_at": time.time()})
+        await close_charts()
+        await storage.close()
+        await bot.session.close()
+        await close_db()
@@ -0,0 +1,103 @@
+import os
+import asyncio
+
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 200))
+WRITE_BATCH_INTERVAL = float(os.getenv("WRITE_BATCH_INTERVAL", 0.05))
+WRITE_QUEUE_MAX = int(os.getenv("WRITE_QUEUE_MAX", 10000))
+
+_STOP = object()
+
+
+# Буфер записи с групповым коммитом: элементы копятся в очереди и сбрасываются
+# одной транзакцией, когда набралось batch_size штук или прошло interval секунд
+# с первого элемента пачки. submit() возвращается только после коммита пачки,
+# так что подтверждать пользователю можно сразу после await.
+class BatchWriter:
+    def __init__(self, flush, batch_size=WRITE_BATCH_SIZE, interval=WRITE_BATCH_INTERVAL,
+                 max_pending=WRITE_QUEUE_MAX):
+        self._flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._full = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self.batches = 0
+        self.items = 0
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, item):
+        if self._closing:
+            raise RuntimeError("Буфер записи остановлен")
+        done = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, done))
+        if self._queue.qsize() >= self.batch_size:
+            self._full.set()
+        return await done
+
+    async def _collect(self):
+        # Возвращает (пачка, пора ли остановиться)
+        entry = await self._queue.get()
+        if entry is _STOP:
+            return [], True
+        batch = [entry]
+        if self._queue.qsize() + 1 < self.batch_size:
+            # Ждём добора пачки, но не дольше interval
+            self._full.clear()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+        while len(batch) < self.batch_size and not self._queue.empty():
+            entry = self._queue.get_nowait()
+            if entry is _STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    async def _write(self, batch):
+        try:
+            await self._flush([item for item, _ in batch])
+        except Exception as e:
+            for _, done in batch:
+                if not done.done():
+                    done.set_exception(e)
+        else:
+            self.batches += 1
+            self.items += len(batch)
+            for _, done in batch:
+                if not done.done():
+                    done.set_result(None)
+
+    async def _run(self):
+        while True:
+            batch, stopping = await self._collect()
+            if batch:
+                await self._write(batch)
+            if stopping:
+                return
+
+    async def stop(self):
+        # Новые записи не принимаем, всё накопленное дописываем
+        if self._task is None:
+            return
+        self._closing = True
+        await self._queue.put(_STOP)
+        self._full.set()
+        await self._task
+        self._task = None
+        leftovers = []
+        while not self._queue.empty():
+            entry = self._queue.get_nowait()
+            if entry is not _STOP:
+                leftovers.append(entry)
+        for start in range(0, len(leftovers), self.batch_size):
+            await self._write(leftovers[start:start + self.batch_size])